@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+import sys, os, json, time, hashlib, argparse, resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from fetching import Body
+
+fixturedir = 'fixtures'
+baselinefile = 'benchmark-baseline.json'
+
+groups = ['thl', 'vax', 'vaxinc', 'ttr', 'wom']
+
+
+# response bodies of one dataset, stored by url
+class FixtureStore:
+
+    def __init__(self, path):
+        self.path = path
+        self.indexfile = os.path.join(path, 'index.json')
+        if os.path.exists(self.indexfile):
+            with open(self.indexfile) as fp:
+                self.index = json.load(fp)
+        else:
+            self.index = {}
+
+    def filename(self, url):
+        return os.path.join(self.path, self.index[url])
+
+    def record(self, fetch):
+        def recorder(url, *args, **kwargs):
+            body = fetch(url, *args, **kwargs)
+            self.index[url] = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+            os.makedirs(self.path, exist_ok=True)
+            body.copy(self.filename(url))
+            with open(self.indexfile, 'w') as fp:
+                json.dump(self.index, fp, indent=1, sort_keys=True)
+            return body
+        return recorder
+
+    def read(self, url):
+        if url not in self.index:
+            raise KeyError("no fixture for %s in %s" % (url, self.path))
+        with open(self.filename(url), 'rb') as fp:
+            return fp.read()
+
+    # maps the fixture file itself, it is not removed on release
+    def replay(self, url, *args, **kwargs):
+        if url not in self.index:
+            raise KeyError("no fixture for %s in %s" % (url, self.path))
+        return Body(self.filename(url), owned=False)
+
+
+class CountingWriter:
+
+    def __init__(self):
+        self.records = 0
+
+    def write(self, text):
+        self.records += text.count('\n')
+
+    def flush(self):
+        pass
+
+
+def listdatasets(group):
+    if group == 'thl':
+        import thldata
+        return sorted(thldata.datasets)
+    elif group == 'vax':
+        import vaxdata
+        return sorted(vaxdata.datasets)
+    elif group == 'vaxinc':
+        import vaxincdata
+        return sorted(vaxincdata.datasets)
+    elif group == 'ttr':
+        import ttrdata
+        return sorted(ttrdata.datasets)
+    elif group == 'wom':
+        import womparser
+        return sorted(womparser.datasets)
+
+
+def alldatasets():
+    return ["%s:%s" % (group, name) for group in groups for name in listdatasets(group)]
+
+
+# returns (dataset object, run function) for a "group:name" dataset
+def getdataset(qualname):
+    (group, name) = qualname.split(':')
+    if group == 'wom':
+        import womparser
+        (url, methodname) = womparser.datasets[name]
+        parser = womparser.WOMParser(url)
+        return parser, lambda output: womparser.run(getattr(parser, methodname), output)
+    elif group == 'ttr':
+        import ttrdata
+        ds = ttrdata.datasets[name]()
+        return ds, ds.run
+
+    if group == 'thl':
+        import thldata as module
+    elif group == 'vax':
+        import vaxdata as module
+    elif group == 'vaxinc':
+        import vaxincdata as module
+    ds = module.datasets[name]()
+    ds.setdatadate()
+    return ds, ds.run
+
+
+def fixturepath(qualname):
+    return os.path.join(fixturedir, qualname.replace(':', '-'))
+
+
+def record(qualname):
+    ds, run = getdataset(qualname)
+    store = FixtureStore(fixturepath(qualname))
+    ds.fetch = store.record(ds.fetch)
+    with open(os.devnull, 'w') as devnull:
+        run(devnull)
+    return len(store.index)
+
+
+def measure(qualname, factor=1, dimension=None):
+    ds, run = getdataset(qualname)
+    store = FixtureStore(fixturepath(qualname))
+    ds.fetch = store.replay
+    if factor > 1:
+        import jsonstatgen
+        bodies = {
+            url: jsonstatgen.scalebody(store.read(url), factor, dimension)
+            for url in store.index
+        }
+        ds.fetch = lambda url, *args, **kwargs: Body.frombytes(bodies[url])
+    writer = CountingWriter()
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            start = time.perf_counter()
+            run(writer)
+            wall = time.perf_counter() - start
+        finally:
+            sys.stdout = stdout
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return dict(
+        wall = wall,
+        records = writer.records,
+        records_per_s = writer.records / wall if wall else 0,
+        rss_mb = rss,
+    )
+
+
+def measureisolated(qualname, repeat, factor=1, dimension=None):
+    # every run gets a fresh interpreter so peak RSS is per dataset
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results.append(executor.submit(measure, qualname, factor, dimension).result())
+    best = min(results, key=lambda r: r['wall'])
+    best['rss_mb'] = max(r['rss_mb'] for r in results)
+    return best
+
+
+def compare(result, base, threshold):
+    regressions = []
+    for attr in ('wall', 'rss_mb'):
+        if attr in base and result[attr] > base[attr] * (1 + threshold):
+            regressions.append("%s %.3f > %.3f" % (attr, result[attr], base[attr]))
+    return regressions
+
+
+def selectdatasets(names):
+    if not names:
+        return [name for name in alldatasets() if os.path.exists(fixturepath(name))]
+    selected = []
+    for name in names:
+        if ':' in name:
+            selected.append(name)
+        else:
+            selected.extend("%s:%s" % (name, ds) for ds in listdatasets(name))
+    return selected
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "-b",
+        "--baseline",
+        action="store",
+        dest="baseline",
+        default=baselinefile,
+        help="baseline file",
+    )
+    p.add_argument(
+        "-u",
+        "--update-baseline",
+        action="store_true",
+        dest="update_baseline",
+        default=False,
+        help="store results as the new baseline",
+    )
+    p.add_argument(
+        "-t",
+        "--threshold",
+        action="store",
+        type=float,
+        dest="threshold",
+        default=0.2,
+        help="allowed slowdown relative to baseline",
+    )
+    p.add_argument(
+        "-r",
+        "--repeat",
+        action="store",
+        type=int,
+        dest="repeat",
+        default=3,
+        help="runs per dataset, best wall time is reported",
+    )
+    p.add_argument(
+        "-x",
+        "--scale",
+        action="store",
+        type=int,
+        dest="scale",
+        default=1,
+        help="scale json-stat fixtures by this factor",
+    )
+    p.add_argument(
+        "-D",
+        "--scale-dimension",
+        action="store",
+        dest="scale_dimension",
+        default=None,
+        help="dimension to scale, default is the outermost one",
+    )
+    p.add_argument("cmd", choices=['record', 'run', 'list'])
+    p.add_argument("datasets", nargs='*', help="group (thl, vax, ...) or group:dataset")
+
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.cmd == 'list':
+        for name in alldatasets():
+            print(name, "(recorded)" if os.path.exists(fixturepath(name)) else "")
+        return
+
+    datasets = selectdatasets(args.datasets)
+
+    if args.cmd == 'record':
+        for name in datasets:
+            print(name, record(name), "responses")
+        return
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+
+    regressions = 0
+    print("%-28s %9s %9s %12s %9s" % ("dataset", "wall s", "records", "records/s", "rss MB"))
+    for name in datasets:
+        result = measureisolated(name, args.repeat, args.scale, args.scale_dimension)
+        if args.scale > 1:
+            name = "%s x%d" % (name, args.scale)
+        problems = compare(result, baseline.get(name, {}), args.threshold)
+        print("%-28s %9.3f %9d %12.0f %9.1f %s" % (
+            name, result['wall'], result['records'], result['records_per_s'], result['rss_mb'],
+            "REGRESSION: " + ", ".join(problems) if problems else ""))
+        if problems:
+            regressions += 1
+        if args.update_baseline:
+            baseline[name] = result
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as fp:
+            json.dump(baseline, fp, indent=1, sort_keys=True)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
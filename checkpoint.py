@@ -0,0 +1,78 @@
+import os, sys, json
+
+
+# Results of the finished sub-requests of a long job (one url or country
+# page each), appended to a json lines file as they complete so a job
+# that is run again after a failure only fetches what is missing. With
+# no path nothing is stored.
+#
+# The first line holds the stamp of the job (dataset and datadate); a
+# checkpoint with another stamp is from a different run and is started
+# over. A line cut short by a crash is dropped.
+class Checkpoint:
+
+    def __init__(self, path=None, stamp=None, restart=False):
+        self.path = path
+        self.stamp = stamp
+        self.done = {}
+        self.fp = None
+        if path and os.path.exists(path) and not restart:
+            self.load()
+        if self.done:
+            print("%s: resuming with %d finished requests" % (path, len(self.done)), file=sys.stderr)
+
+    def load(self):
+        good = 0
+        with open(self.path, 'rb') as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                if good == 0:
+                    if entry.get('stamp') != self.stamp:
+                        return
+                else:
+                    self.done[entry['key']] = entry['value']
+                good += len(line)
+        if good:
+            # appends continue after the last complete line
+            self.fp = open(self.path, 'r+')
+            self.fp.truncate(good)
+            self.fp.seek(good)
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def get(self, key, default=None):
+        return self.done.get(key, default)
+
+    def write(self, entry):
+        self.fp.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def add(self, key, value):
+        self.done[key] = value
+        if not self.path:
+            return
+        if self.fp is None:
+            self.fp = open(self.path, 'w')
+            self.write(dict(stamp=self.stamp))
+        self.write(dict(key=key, value=value))
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    # the job has written its output, the checkpoint is not needed anymore
+    def finish(self):
+        self.close()
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
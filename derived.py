@@ -0,0 +1,158 @@
+import os, re, json, math, array, bisect
+
+import temporal
+from values import decimals
+
+# the population key of records without an area or country
+top = "Koko maa"
+
+nan = float('nan')
+
+
+# a measure column as floats, nan where there is no number
+def numbers(column):
+    try:
+        return array.array('d', decimals(column, nan))
+    except (ValueError, TypeError):
+        pass
+    result = array.array('d')
+    for v in column:
+        try:
+            result.extend(decimals([v], nan))
+        except (ValueError, TypeError):
+            result.append(nan)
+    return result
+
+
+def number(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return round(value, 6)
+
+
+# Fields derived from the measures of a daily or weekly dataset once all of
+# its records have been read: the sum over the last 7 days
+# (<measure>-7d), the sum per 100 000 inhabitants (-7d-per100k) and its
+# growth from 7 days before (-7d-growth). A series is the records with the
+# same seriesfields, ordered by the date or week in datefield; a sum is
+# None unless every day of the window has a value. A record's population
+# is looked up by its area or country ("Koko maa" without either) in
+# population, and is its own population field if it is not there.
+#
+# Records added as history (earlier outputs) count in the sums but are
+# not returned.
+class Derived:
+
+    def __init__(self, datefield, seriesfields, measures, population=None, separator="-"):
+        self.datefield = datefield
+        self.seriesfields = tuple(seriesfields)
+        self.measures = tuple(measures)
+        self.population = population or {}
+        self.separator = separator
+        self.records = []
+
+    def add(self, records, history=False):
+        for record in records:
+            values = record if isinstance(record, dict) else record.values()
+            self.records.append((record, values, history))
+
+    # the records that are not history, in the order they were added, with
+    # the derived fields
+    def finish(self):
+        series = {}
+        for (i, (record, values, history)) in enumerate(self.records):
+            label = values.get(self.datefield)
+            ordinal = temporal.decode(label)[1] if isinstance(label, str) else None
+            if ordinal is None:
+                # totals like "Kaikki ajat"
+                continue
+            key = tuple(values.get(f) for f in self.seriesfields)
+            series.setdefault(key, {})[ordinal] = i
+        for rows in series.values():
+            self.derive(sorted(rows.items()))
+        return [record for (record, values, history) in self.records if not history]
+
+    def field(self, *parts):
+        return self.separator.join(parts)
+
+    # the fields derive() adds
+    def fieldnames(self):
+        return [self.field(measure, *suffix) for measure in self.measures
+                for suffix in (("7d",), ("7d", "per100k"), ("7d", "growth"))]
+
+    def populationof(self, values):
+        name = values.get('area') or values.get('country') or top
+        if name in self.population:
+            return self.population[name]
+        value = numbers([values.get('population')])[0]
+        return None if math.isnan(value) else value
+
+    # rows are the (ordinal, index) of a series in date order
+    def derive(self, rows):
+        ordinals = array.array('l', (o for (o, i) in rows))
+        rows = [self.records[i][1] for (o, i) in rows]
+        # 7 daily values or one weekly value make a window
+        step = min((b - a for (a, b) in zip(ordinals, ordinals[1:])), default=7)
+        width = max(1, 7 // step)
+        population = self.populationof(rows[-1])
+
+        for measure in self.measures:
+            if not any(measure in values for values in rows):
+                continue
+            column = numbers([values.get(measure) for values in rows])
+            sums = array.array('d', [0.0])
+            gaps = array.array('l', [0])
+            for v in column:
+                sums.append(sums[-1] + (0.0 if math.isnan(v) else v))
+                gaps.append(gaps[-1] + math.isnan(v))
+
+            windows = []
+            for n in range(len(rows)):
+                start = n - width + 1
+                complete = (start >= 0 and gaps[n + 1] == gaps[start]
+                            and ordinals[n] - ordinals[start] == (width - 1) * step)
+                windows.append(sums[n + 1] - sums[start] if complete else None)
+
+            for (n, values) in enumerate(rows):
+                total = windows[n]
+                before = bisect.bisect_left(ordinals, ordinals[n] - 7)
+                previous = windows[before] if before < n and ordinals[before] == ordinals[n] - 7 else None
+                values[self.field(measure, "7d")] = None if total is None else number(total)
+                values[self.field(measure, "7d", "per100k")] = (
+                    round(total * 100000 / population, 2) if total is not None and population else None)
+                values[self.field(measure, "7d", "growth")] = (
+                    round(total / previous - 1, 4) if total is not None and previous else None)
+
+
+# area or country -> population from a kunnat, vaxpopulation, alueet or
+# womparser population output
+def loadpopulation(path):
+    population = {}
+    with open(path, encoding='utf-8') as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            values = json.loads(line)
+            name = values.get('area') or values.get('country')
+            value = values.get('population', values.get('all'))
+            if name is not None and isinstance(value, (int, float)):
+                population[name] = value
+    # kunnat has no row for the whole country
+    if top not in population:
+        population[top] = sum(population.values())
+    return population
+
+
+# the records of the <name>-YYYYMMDD.json outputs in directory from the
+# days before before (YYYYMMDD), at most days of them
+def loadhistory(directory, name, before, days=14):
+    dates = []
+    for filename in os.listdir(directory or '.'):
+        m = re.match(r'%s-(\d{8})\.json$' % re.escape(name), filename)
+        if m and m.group(1) < before:
+            dates.append(m.group(1))
+    records = []
+    for date in sorted(dates)[-days:]:
+        with open(os.path.join(directory, '%s-%s.json' % (name, date)), encoding='utf-8') as fp:
+            records.extend(json.loads(line) for line in fp if line.strip())
+    return records
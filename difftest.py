@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+import sys, os, io, json, time, argparse, contextlib
+
+import temporal
+from fetching import Body
+from records import recordkey
+from sinks import pipeline
+from values import convert
+from benchmark import FixtureStore, getdataset, fixturepath, selectdatasets
+
+
+# The cells of a THLData cube decoded one at a time, every label mapped
+# and every value converted on its own, as Parser.parse did before it
+# worked per dimension and per column.
+def legacyparse(ds):
+    from thldata import ParserData
+    if ds.parser is None:
+        ds.parser = ds.load()
+    dimensions = ds.parser.loaddimensions()[::-1]
+    valuetype = type(ds).valuetype
+    for (key, value) in ds.parser.dataset["value"].items():
+        idx = int(key)
+        jd = {}
+        celltype = valuetype
+        for d in dimensions:
+            label = d.categories[idx % d.size]
+            field = ds.mapfield(d.name)
+            jd[field] = ds.mapvalue(label)
+            if ds.isodates and temporal.istime(d.name):
+                jd[field] = temporal.decode(label)[0] or jd[field]
+            if field == ds.measurefield:
+                celltype = ds.measuretypes.get(jd[field], valuetype)
+            idx = idx // d.size
+        jd[ds.mapfield("value")] = ds.mapvalue(convert([value], celltype)[0])
+        yield ParserData(jd)
+
+
+# AgeParser as it was before the dense blocks: every value goes into a
+# nested area -> time -> sex dict, the yearly values are added to the
+# total as they come, and the records are written at the end.
+def legacyages(ds):
+    import csv
+    from ttrdata import UrlGen
+
+    data = {}
+    for year in ds.years:
+        for agegroup in UrlGen.agegroups:
+            for sex in ds.sexes:
+                for measure in ds.measures:
+                    url = UrlGen.genurl(time=year, agegroup=agegroup, sex=sex, measure=measure)
+                    with ds.fetch(url) as body:
+                        reader = csv.DictReader(io.StringIO(body.text(), newline=''), delimiter=';')
+                        rows = []
+                        for l in reader:
+                            if l['val']:
+                                value = float(l['val']) if measure == 'incidence' else int(l['val'])
+                            else:
+                                value = 0
+                            rows.append([l['Alue'], l['time'], value])
+                    attrname = "{}_{}".format(measure, ds.agegroup_to_attr(agegroup))
+                    for (area, time, value) in rows:
+                        data.setdefault(area, {}).setdefault(time, {}).setdefault(sex, {})[attrname] = value
+                        if time in ds.years:
+                            total = data[area].setdefault('total', {}).setdefault(sex, {})
+                            total[attrname] = total.get(attrname, 0) + value
+
+    for area in data:
+        for time in data[area]:
+            for sex in data[area][time]:
+                d = dict(
+                    type = 'ttrages',
+                    area = area.replace('sairaanhoitopiiri', 'SHP'),
+                    time = time,
+                    sex = sex,
+                    datadate = str(ds.datadate),
+                )
+                d.update(data[area][time][sex])
+                yield d
+
+
+# (name, function(ds, run, output, jobs)) of the paths of a group; the
+# first is the legacy path the others are compared with
+def thlpaths(ds):
+    def legacy(ds, run, output, jobs):
+        ds.parse = lambda: legacyparse(ds)
+        run(output)
+
+    def serial(ds, run, output, jobs):
+        ds.process(output)
+
+    def sharded(ds, run, output, jobs):
+        ds.jobs = jobs
+        ds.process(output)
+
+    def threaded(ds, run, output, jobs):
+        with pipeline(output) as out:
+            ds.process(out)
+
+    return [("legacy", legacy), ("serial", serial), ("sharded", sharded), ("pipeline", threaded)]
+
+
+def ttrpaths(ds):
+    def legacy(ds, run, output, jobs):
+        for d in legacyages(ds):
+            print(json.dumps(d, sort_keys=True, ensure_ascii=False), file=output)
+
+    def blocks(ds, run, output, jobs):
+        run(output)
+
+    return [("legacy", legacy), ("blocks", blocks)]
+
+
+def wompaths(ds):
+    def serial(ds, run, output, jobs):
+        run(output)
+
+    def parallel(ds, run, output, jobs):
+        ds.jobs = jobs
+        run(output)
+
+    return [("serial", serial), ("parallel", parallel)]
+
+
+def paths(qualname, ds):
+    group = qualname.split(':')[0]
+    if group == 'ttr':
+        return ttrpaths(ds)
+    elif group == 'wom':
+        return wompaths(ds)
+    return thlpaths(ds)
+
+
+# runs one path on a new dataset object, returns its records and wall time
+def runpath(qualname, path, fetch, jobs):
+    (ds, run) = getdataset(qualname)
+    ds.fetch = fetch
+    output = io.StringIO()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        path(ds, run, output, jobs)
+        wall = time.perf_counter() - start
+    return [json.loads(line) for line in output.getvalue().splitlines() if line.strip()], wall
+
+
+# the records by natural key, a key seen twice is reported as duplicate
+def normalize(records):
+    byname = {}
+    duplicates = []
+    for values in records:
+        key = recordkey(values)
+        if key in byname:
+            duplicates.append(key)
+        byname[key] = values
+    return byname, duplicates
+
+
+# the differences of records from the legacy ones, as text
+def divergences(legacy, records):
+    (expected, _) = normalize(legacy)
+    (got, duplicates) = normalize(records)
+    found = ["duplicate %s" % (key,) for key in duplicates]
+    for key in expected:
+        if key not in got:
+            found.append("missing %s" % (key,))
+    for (key, values) in got.items():
+        if key not in expected:
+            found.append("extra %s" % (key,))
+            continue
+        for field in sorted(set(values) | set(expected[key])):
+            if values.get(field, '<none>') != expected[key].get(field, '<none>'):
+                found.append("%s %s: %r != %r" % (key, field, values.get(field, '<none>'),
+                                                 expected[key].get(field, '<none>')))
+    if not found and [recordkey(v) for v in legacy] != [recordkey(v) for v in records]:
+        # the same records in another order is reported but is no divergence
+        return [], "reordered"
+    return found, ""
+
+
+def fetcher(qualname, bodyfile):
+    if bodyfile:
+        with open(bodyfile, 'rb') as fp:
+            body = fp.read()
+        return lambda url, *args, **kwargs: Body.frombytes(body)
+    return FixtureStore(fixturepath(qualname)).replay
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "-F",
+        "--body",
+        action="store",
+        dest="body",
+        default=None,
+        help="answer every request with this file instead of the recorded fixtures",
+    )
+    p.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        dest="jobs",
+        default=2,
+        help="processes for the sharded and parallel paths",
+    )
+    p.add_argument(
+        "-n",
+        "--show",
+        action="store",
+        type=int,
+        dest="show",
+        default=10,
+        help="divergences to print per path",
+    )
+    p.add_argument(
+        "-p",
+        "--paths",
+        action="store",
+        dest="paths",
+        default=None,
+        help="comma separated paths to compare with the legacy one, default all",
+    )
+    p.add_argument("datasets", nargs='*', help="group (thl, vax, ...) or group:dataset")
+
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    selected = args.paths.split(',') if args.paths else None
+
+    failed = 0
+    print("%-28s %-9s %9s %9s %8s  %s" % ("dataset", "path", "records", "wall s", "speedup", "result"))
+    for name in selectdatasets(args.datasets):
+        fetch = fetcher(name, args.body)
+        (ds, run) = getdataset(name)
+        (base, *others) = paths(name, ds)
+        (legacy, basewall) = runpath(name, base[1], fetch, args.jobs)
+        print("%-28s %-9s %9d %9.3f" % (name, base[0], len(legacy), basewall))
+        for (pathname, path) in others:
+            if selected and pathname not in selected:
+                continue
+            (records, wall) = runpath(name, path, fetch, args.jobs)
+            (found, note) = divergences(legacy, records)
+            print("%-28s %-9s %9d %9.3f %7.2fx  %s" % (
+                "", pathname, len(records), wall, basewall / wall if wall else 0,
+                "%d divergences" % len(found) if found else note or "same"))
+            for line in found[:args.show]:
+                print("    " + line)
+            if found:
+                failed += 1
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
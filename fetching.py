@@ -0,0 +1,197 @@
+import sys, os, json, mmap, time, random, shutil, tempfile, urllib.parse
+
+# response bodies are spooled to files here and mapped by whoever parses
+# them, so handing a body to another process only passes its path
+spooldir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+chunksize = 1 << 16
+
+timeout = 60
+# attempts per request, the first retry waits up to backoff seconds and
+# every further one twice as long, with full jitter
+retries = 5
+backoff = 2.0
+maxbackoff = 60.0
+# retries per host for the whole run, so a dead host does not cost
+# retries * requests sleeps
+hostbudget = 30
+# consecutive failures after which requests to a host fail at once for
+# cooldown seconds
+breakerthreshold = 5
+breakercooldown = 120.0
+
+
+class FetchError(Exception):
+    pass
+
+
+class CircuitOpen(FetchError):
+    pass
+
+
+class Host:
+
+    def __init__(self, name):
+        self.name = name
+        self.budget = hostbudget
+        self.failures = 0
+        self.openuntil = 0.0
+
+    def check(self):
+        if self.failures >= breakerthreshold:
+            if time.monotonic() < self.openuntil:
+                raise CircuitOpen("%s failed %d times in a row, not retrying before %.0fs" % (
+                    self.name, self.failures, self.openuntil - time.monotonic()))
+            # half open, let one request through
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= breakerthreshold:
+            self.openuntil = time.monotonic() + breakercooldown
+
+
+hosts = {}
+
+
+def gethost(url):
+    name = urllib.parse.urlsplit(url).netloc
+    if name not in hosts:
+        hosts[name] = Host(name)
+    return hosts[name]
+
+
+# A response body in a memory-mapped spool file. view() returns a
+# memoryview of the mapping; release() unmaps it and removes the file if
+# the body owns it. Pickling a Body passes the path, not the data.
+class Body:
+    status = 200
+    headers = {}
+
+    def __init__(self, path, owned=True):
+        self.path = path
+        self.owned = owned
+        self.size = os.path.getsize(path)
+        self.fp = None
+        self.map = None
+
+    @classmethod
+    def frombytes(cls, data):
+        (fd, path) = tempfile.mkstemp(prefix='coviddata-', dir=spooldir)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        return cls(path)
+
+    def __getstate__(self):
+        return dict(path=self.path, owned=self.owned, size=self.size, fp=None, map=None,
+                    status=self.status, headers=self.headers)
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    # use as "with body.view() as view:" so the view is gone before release()
+    def view(self):
+        if self.size == 0:
+            return memoryview(b'')
+        if self.map is None:
+            self.fp = open(self.path, 'rb')
+            self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self.map)
+
+    def text(self, encoding='utf-8'):
+        with self.view() as view:
+            return str(view, encoding)
+
+    # the json decoder only takes a whole str or bytes (which it decodes to
+    # a str first), so the body is decoded straight from the mapping into
+    # one str that is dropped as soon as it is parsed
+    def json(self, encoding='utf-8'):
+        with self.view() as view:
+            return json.loads(str(view, encoding))
+
+    def copy(self, path):
+        shutil.copyfile(self.path, path)
+
+    def release(self):
+        if self.map is not None:
+            self.map.close()
+            self.fp.close()
+            self.map = None
+            self.fp = None
+        if self.owned:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                # released by the process that parsed it
+                pass
+            self.owned = False
+
+
+# seconds to wait before retrying, None if the error is not worth a retry
+def retrydelay(error, attempt):
+    import requests
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code
+        if status < 500 and status != 429:
+            return None
+        after = error.response.headers.get('Retry-After', '')
+        if after.isdigit():
+            return min(float(after), maxbackoff)
+    elif not isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return None
+    return random.uniform(0, min(maxbackoff, backoff * 2 ** attempt))
+
+
+# Fetches url into a spool file. Server errors, 429 and connection
+# failures are retried; other error statuses raise if check is set and
+# are returned like any body otherwise.
+def download(url, headers=None, check=True):
+    host = gethost(url)
+    attempt = 0
+    while True:
+        host.check()
+        try:
+            body = get(url, headers, check)
+        except Exception as e:
+            delay = retrydelay(e, attempt)
+            if delay is None:
+                raise
+            host.failure()
+            if attempt + 1 >= retries or host.budget <= 0:
+                raise FetchError("%s: giving up after %d attempts: %s" % (url, attempt + 1, e)) from e
+            host.budget -= 1
+            attempt += 1
+            print("%s: %s, retry %d in %.1fs" % (url, e, attempt, delay), file=sys.stderr)
+            time.sleep(delay)
+            continue
+        host.success()
+        return body
+
+
+def get(url, headers, check):
+    import requests
+    r = requests.get(url, headers=headers, stream=True, timeout=timeout)
+    try:
+        if check or r.status_code >= 500 or r.status_code == 429:
+            r.raise_for_status()
+        (fd, path) = tempfile.mkstemp(prefix='coviddata-', dir=spooldir)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                for chunk in r.iter_content(chunksize):
+                    fp.write(chunk)
+        except BaseException:
+            os.unlink(path)
+            raise
+    finally:
+        r.close()
+    body = Body(path)
+    body.status = r.status_code
+    body.headers = dict(r.headers)
+    return body
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+import sys, json, time, random, argparse
+
+import temporal
+
+
+def makelabel(name, i, labellength):
+    label = "%s %d" % (name, i)
+    if labellength and len(label) < labellength:
+        label = label + " " + "x" * (labellength - len(label) - 1)
+    return label
+
+
+def makedimension(labels, firstid=0):
+    ids = [str(firstid + i) for i in range(len(labels))]
+    return {
+        "category": {
+            "index": {k: i for (i, k) in enumerate(ids)},
+            "label": dict(zip(ids, labels)),
+        }
+    }
+
+
+def makevalue(rnd, missing, decimals):
+    if missing and rnd.random() < missing:
+        return ".."
+    if decimals:
+        return ("%.1f" % (rnd.random() * 1000)).replace('.', ',')
+    return str(rnd.randint(0, 100000))
+
+
+# dimensions is a list of (name, size) or (name, [labels])
+def generate(dimensions, sparsity=0.0, missing=0.0, labellength=None, decimals=False, seed=0):
+    rnd = random.Random(seed)
+    ids = []
+    sizes = []
+    dimension = {"id": ids, "size": sizes}
+    firstid = 100000
+    for (name, labels) in dimensions:
+        if isinstance(labels, int):
+            labels = [makelabel(name, i, labellength) for i in range(labels)]
+        ids.append(name)
+        sizes.append(len(labels))
+        dimension[name] = makedimension(labels, firstid)
+        firstid += len(labels)
+
+    total = 1
+    for size in sizes:
+        total *= size
+
+    values = {}
+    for idx in range(total):
+        if sparsity and rnd.random() < sparsity:
+            continue
+        values[str(idx)] = makevalue(rnd, missing, decimals)
+
+    return {"dataset": {"dimension": dimension, "value": values}}
+
+
+def categories(dimension):
+    category = dimension["category"]
+    return sorted(category["index"], key=lambda k: category["index"][k])
+
+
+# the labels of the copy-th copy of labels: weeks, months and days continue
+# after the last of the originals so that they still decode as dates,
+# other labels (and totals like "Kaikki ajat") get a #n suffix
+def copylabels(labels, copy):
+    periods = [temporal.period(label) for label in labels]
+    spans = {}
+    for (kind, number) in periods:
+        if kind:
+            (low, high) = spans.get(kind, (number, number))
+            spans[kind] = (min(low, number), max(high, number))
+    newlabels = []
+    for (label, (kind, number)) in zip(labels, periods):
+        if kind:
+            (low, high) = spans[kind]
+            newlabels.append(temporal.label(kind, number + (copy - 1) * (high - low + 1)))
+        else:
+            newlabels.append("%s #%d" % (label, copy))
+    return newlabels
+
+
+# repeats the categories of one dimension factor times, copying the values
+# of the original cells to every copy
+def scale(doc, factor, dimensionname=None):
+    dataset = doc["dataset"]
+    ids = dataset["dimension"]["id"]
+    sizes = dataset["dimension"]["size"]
+    if dimensionname is None:
+        dimensionname = ids[0]
+    pos = ids.index(dimensionname)
+
+    keys = categories(dataset["dimension"][dimensionname])
+    labels = dataset["dimension"][dimensionname]["category"]["label"]
+    newlabels = [labels[k] for k in keys]
+    for copy in range(1, factor):
+        newlabels.extend(copylabels([labels[k] for k in keys], copy + 1))
+
+    dimension = dict(dataset["dimension"])
+    dimension[dimensionname] = makedimension(newlabels, 10000000)
+    dimension["size"] = list(sizes)
+    dimension["size"][pos] = len(newlabels)
+
+    size = sizes[pos]
+    inner = 1
+    for s in sizes[pos+1:]:
+        inner *= s
+
+    values = {}
+    for (k, v) in dataset["value"].items():
+        idx = int(k)
+        (outer, rest) = divmod(idx, size * inner)
+        (cat, rest) = divmod(rest, inner)
+        for copy in range(factor):
+            newidx = (outer * size * factor + copy * size + cat) * inner + rest
+            values[str(newidx)] = v
+
+    # keep the value keys in ascending order like the THL api does
+    values = {k: values[k] for k in sorted(values, key=int)}
+    return {"dataset": {"dimension": dimension, "value": values}}
+
+
+def scalebody(body, factor, dimensionname=None):
+    if not body.lstrip().startswith(b'{'):
+        return body
+    doc = json.loads(body)
+    if "dataset" not in doc:
+        return body
+    if dimensionname and dimensionname not in doc["dataset"]["dimension"]["id"]:
+        return body
+    return json.dumps(scale(doc, factor, dimensionname), ensure_ascii=False).encode('utf-8')
+
+
+def timeparse(doc):
+    from thldata import Parser, THLData
+    p = Parser(data=doc)
+    start = time.perf_counter()
+    cells = 0
+    for data in p.parse(mapper=THLData()):
+        cells += 1
+    return cells, time.perf_counter() - start
+
+
+def parsedimension(text):
+    (name, size) = text.split('=')
+    return (name, int(size))
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "-f",
+        "--outputfile",
+        action="store",
+        dest="outputfile",
+        default=None,
+        help="outputfile name",
+    )
+    p.add_argument(
+        "-D",
+        "--dimension",
+        action="append",
+        dest="dimensions",
+        default=[],
+        help="generate: name=size, outermost first; scale: dimension to scale",
+    )
+    p.add_argument(
+        "-x",
+        "--factor",
+        action="store",
+        type=int,
+        dest="factor",
+        default=10,
+        help="scale factor",
+    )
+    p.add_argument(
+        "--sparsity",
+        action="store",
+        type=float,
+        dest="sparsity",
+        default=0.0,
+        help="fraction of cells left out of value",
+    )
+    p.add_argument(
+        "--missing",
+        action="store",
+        type=float,
+        dest="missing",
+        default=0.0,
+        help="fraction of '..' values",
+    )
+    p.add_argument(
+        "--label-length",
+        action="store",
+        type=int,
+        dest="labellength",
+        default=None,
+        help="pad category labels to this length",
+    )
+    p.add_argument(
+        "--decimals",
+        action="store_true",
+        dest="decimals",
+        default=False,
+        help="generate values with decimal comma",
+    )
+    p.add_argument(
+        "--seed",
+        action="store",
+        type=int,
+        dest="seed",
+        default=0,
+        help="random seed",
+    )
+    p.add_argument("cmd", choices=['generate', 'scale', 'parse'])
+    p.add_argument("inputfile", nargs='?', help="json-stat file for scale and parse")
+
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.cmd == 'generate':
+        doc = generate(
+            [parsedimension(d) for d in args.dimensions],
+            sparsity=args.sparsity,
+            missing=args.missing,
+            labellength=args.labellength,
+            decimals=args.decimals,
+            seed=args.seed,
+        )
+    else:
+        if not args.inputfile:
+            print("%s needs an inputfile" % args.cmd)
+            return
+        with open(args.inputfile) as fp:
+            doc = json.load(fp)
+
+    if args.cmd == 'scale':
+        dimensionname = args.dimensions[0] if args.dimensions else None
+        doc = scale(doc, args.factor, dimensionname)
+
+    if args.cmd == 'parse':
+        (cells, seconds) = timeparse(doc)
+        print("%d cells in %.3f s, %.0f cells/s" % (cells, seconds, cells / seconds if seconds else 0))
+        return
+
+    if args.outputfile:
+        with open(args.outputfile, 'w') as fp:
+            json.dump(doc, fp, ensure_ascii=False)
+    else:
+        json.dump(doc, sys.stdout, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
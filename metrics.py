@@ -0,0 +1,83 @@
+import os, json, time, contextlib
+
+
+class Metrics:
+    prefix = "coviddata"
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def timed(self, stage, iterable, counter):
+        # time spent inside the iterator, not in the loop consuming it
+        clock = time.perf_counter
+        elapsed = 0.0
+        n = 0
+        it = iter(iterable)
+        try:
+            while True:
+                start = clock()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    elapsed += clock() - start
+                    break
+                elapsed += clock() - start
+                n += 1
+                yield item
+        finally:
+            self.add(stage, elapsed)
+            self.count(counter, n)
+
+    def summary(self):
+        stages = dict(self.stages)
+        stages['total'] = time.perf_counter() - self.started
+        # whatever the dataset did between parsing and writing
+        stages['combine'] = max(0.0, stages['total'] - sum(self.stages.values()))
+        return dict(dataset=self.name, stages=stages, counters=dict(self.counters))
+
+    def tojson(self, summary=None):
+        return json.dumps(summary or self.summary(), sort_keys=True)
+
+    def toprometheus(self, summary=None):
+        summary = summary or self.summary()
+        lines = []
+        lines.append("# TYPE %s_stage_seconds gauge" % self.prefix)
+        for stage in sorted(summary['stages']):
+            lines.append('%s_stage_seconds{dataset="%s",stage="%s"} %f' % (
+                self.prefix, self.name, stage, summary['stages'][stage]))
+        for counter in sorted(summary['counters']):
+            lines.append("# TYPE %s_%s gauge" % (self.prefix, counter))
+            lines.append('%s_%s{dataset="%s"} %d' % (
+                self.prefix, counter, self.name, summary['counters'][counter]))
+        return "\n".join(lines) + "\n"
+
+
+def report(metrics, write_json, path, output):
+    summary = metrics.summary()
+    if write_json:
+        print(metrics.tojson(summary), file=output)
+    if path:
+        if os.path.isdir(path):
+            path = os.path.join(path, "%s.prom" % metrics.name)
+        # write and rename so a textfile collector never sees a partial file
+        tmpfile = path + ".tmp"
+        with open(tmpfile, 'w') as fp:
+            fp.write(metrics.toprometheus(summary))
+        os.replace(tmpfile, path)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import sys, os, json, mmap, bisect, argparse
+
+from records import recordkey
+
+
+def keystring(key):
+    return json.dumps(list(key), ensure_ascii=False)
+
+
+# orders keys with mixed None/str/int fields without comparing across types
+def sortkey(key):
+    return tuple((v is None, type(v).__name__, v) for v in key)
+
+
+# A <dataset>-YYYYMMDD.json output read through mmap. The sidecar
+# <file>.idx holds the offset and length of every line sorted by natural
+# key and is rebuilt when the output's size or mtime changes, so a record
+# is read with one seek and one json decode.
+class OutputFile:
+
+    def __init__(self, path):
+        self.path = path
+        self.indexfile = path + ".idx"
+        self.fp = open(path, 'rb')
+        st = os.fstat(self.fp.fileno())
+        self.stamp = [st.st_size, st.st_mtime_ns]
+        self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b''
+        self.keys = []
+        self.sortkeys = []
+        self.locations = []
+        self.lookup = {}
+        self.loadindex()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.fp.close()
+
+    def lines(self):
+        offset = 0
+        size = len(self.map)
+        while offset < size:
+            end = self.map.find(b'\n', offset)
+            if end < 0:
+                end = size
+            if end > offset:
+                yield offset, end - offset
+            offset = end + 1
+
+    def buildindex(self):
+        entries = []
+        for (offset, length) in self.lines():
+            line = self.map[offset:offset + length]
+            if line.strip():
+                entries.append((list(recordkey(json.loads(line))), offset, length))
+        entries.sort(key=lambda e: (sortkey(e[0]), e[1]))
+
+        tmpfile = self.indexfile + ".tmp"
+        with open(tmpfile, 'w') as fp:
+            json.dump(dict(stamp=self.stamp, entries=entries), fp, ensure_ascii=False)
+        os.replace(tmpfile, self.indexfile)
+        return entries
+
+    def loadindex(self):
+        entries = None
+        if os.path.exists(self.indexfile):
+            with open(self.indexfile) as fp:
+                index = json.load(fp)
+            if index.get('stamp') == self.stamp:
+                entries = index['entries']
+        if entries is None:
+            entries = self.buildindex()
+
+        for (key, offset, length) in entries:
+            key = tuple(key)
+            self.keys.append(key)
+            self.sortkeys.append(sortkey(key))
+            self.locations.append((offset, length))
+            # the first line wins if a key is repeated
+            self.lookup.setdefault(keystring(key), (offset, length))
+
+    def read(self, location):
+        (offset, length) = location
+        return json.loads(self.map[offset:offset + length])
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, key):
+        return keystring(key) in self.lookup
+
+    def get(self, key):
+        location = self.lookup.get(keystring(key))
+        return self.read(location) if location else None
+
+    # records in key order whose key is >= low and whose key, cut to the
+    # length of high, is <= high; low and high may be key prefixes
+    def range(self, low=(), high=None):
+        i = bisect.bisect_left(self.sortkeys, sortkey(low))
+        while i < len(self.keys):
+            if high is not None and sortkey(self.keys[i][:len(high)]) > sortkey(high):
+                break
+            yield self.read(self.locations[i])
+            i += 1
+
+    def prefix(self, prefix):
+        return self.range(prefix, prefix)
+
+    # every record in file order
+    def records(self):
+        for (offset, length) in self.lines():
+            line = self.map[offset:offset + length]
+            if line.strip():
+                yield json.loads(line)
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("cmd", choices=['index', 'get', 'prefix'])
+    p.add_argument("file", help="<dataset>-YYYYMMDD.json file")
+    p.add_argument("key", nargs='*', help="get: natural key; prefix: first fields of the key")
+
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    with OutputFile(args.file) as output:
+        if args.cmd == 'index':
+            print("%s: %d records" % (args.file, len(output)))
+        elif args.cmd == 'get':
+            record = output.get(args.key)
+            if record is None:
+                sys.exit(1)
+            print(json.dumps(record, sort_keys=True, ensure_ascii=False))
+        elif args.cmd == 'prefix':
+            for record in output.prefix(tuple(args.key)):
+                print(json.dumps(record, sort_keys=True, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
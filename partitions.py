@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import os, json, shutil, datetime, argparse, contextlib
+
+import temporal
+from records import recordkey
+from sinks import Sink
+from outputs import sortkey
+
+manifestname = '_manifest.json'
+
+# directory name of a record without a value for a key
+nullvalue = '__HIVE_DEFAULT_PARTITION__'
+
+
+# the monday of the record's week or date field, None for totals
+def recorddate(values):
+    label = values.get('week') or values.get('date')
+    date = temporal.decode(label)[0] if isinstance(label, str) else None
+    if date is None or len(date) != 10:
+        return None
+    return datetime.date.fromisoformat(date)
+
+
+# partition keys computed from the record's date (the field of
+# date.isocalendar()), any other key is a field of the record
+isocalendar = {'isoyear': 0, 'isoweek': 1}
+
+
+def keyvalue(values, key):
+    if key in isocalendar:
+        date = recorddate(values)
+        value = date.isocalendar()[isocalendar[key]] if date else None
+    else:
+        value = values.get(key)
+    return nullvalue if value is None else str(value)
+
+
+# characters that are %XX escaped in a directory name, as hive does
+escaped = frozenset('"#%\'*/:=?\\^{}[]\x7f')
+
+
+def escape(value):
+    return "".join("%%%02X" % ord(c) if c in escaped or ord(c) < 32 else c for c in value)
+
+
+# Writes the records as json lines into a key=value directory tree under
+# directory, e.g. area=Helsinki/part.json, with a _manifest.json listing
+# each partition with its row count and its lowest and highest natural
+# key. Lines are kept per partition and appended to the partition files
+# when batchsize lines are waiting. The tree is built in directory.tmp and
+# replaces directory on close.
+class PartitionedSink(Sink):
+
+    def __init__(self, directory, keys, batchsize=50000):
+        self.directory = directory
+        self.tmpdir = directory.rstrip('/') + ".tmp"
+        self.keys = list(keys)
+        self.batchsize = batchsize
+        self.pending = {}
+        self.waiting = 0
+        self.partitions = {}
+        if os.path.exists(self.tmpdir):
+            shutil.rmtree(self.tmpdir)
+        os.makedirs(self.tmpdir)
+
+    def partitionpath(self, values):
+        return "/".join("%s=%s" % (key, escape(value)) for (key, value) in zip(self.keys, values))
+
+    def write(self, values):
+        partition = tuple(keyvalue(values, key) for key in self.keys)
+        entry = self.partitions.get(partition)
+        key = sortkey(recordkey(values))
+        if entry is None:
+            entry = self.partitions[partition] = dict(
+                path=os.path.join(self.partitionpath(partition), "part.json"),
+                values=dict(zip(self.keys, partition)),
+                rows=0, min=key, max=key)
+            os.makedirs(os.path.join(self.tmpdir, os.path.dirname(entry["path"])), exist_ok=True)
+        entry["rows"] += 1
+        entry["min"] = min(entry["min"], key)
+        entry["max"] = max(entry["max"], key)
+        self.pending.setdefault(partition, []).append(json.dumps(values, sort_keys=True, ensure_ascii=False))
+        self.waiting += 1
+        if self.waiting >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        for (partition, lines) in self.pending.items():
+            with open(os.path.join(self.tmpdir, self.partitions[partition]["path"]), 'a') as fp:
+                fp.write("\n".join(lines) + "\n")
+        self.pending = {}
+        self.waiting = 0
+
+    def manifest(self):
+        partitions = []
+        for entry in sorted(self.partitions.values(), key=lambda e: e["path"]):
+            # sortkey tuples back to the key fields
+            partitions.append(dict(entry, min=[v for (_, _, v) in entry["min"]],
+                                   max=[v for (_, _, v) in entry["max"]]))
+        return dict(keys=self.keys, rows=sum(e["rows"] for e in partitions), partitions=partitions)
+
+    def close(self):
+        self.flush()
+        with open(os.path.join(self.tmpdir, manifestname), 'w') as fp:
+            json.dump(self.manifest(), fp, indent=1, ensure_ascii=False)
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.replace(self.tmpdir, self.directory)
+
+    def discard(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+# keys from a comma separated --partition-by, or the dataset's own
+def partitionkeys(text, default):
+    return text.split(',') if text else list(default)
+
+
+@contextlib.contextmanager
+def partitioned(directory, keys):
+    sink = PartitionedSink(directory, keys)
+    try:
+        yield sink
+    except BaseException:
+        sink.discard()
+        raise
+    sink.close()
+
+
+def readmanifest(directory):
+    with open(os.path.join(directory, manifestname)) as fp:
+        return json.load(fp)
+
+
+# the manifest entries of the partitions whose key values match filters
+# (key -> value), so a reader opens only those
+def select(directory, filters=None):
+    manifest = readmanifest(directory)
+    return [entry for entry in manifest["partitions"]
+            if all(entry["values"].get(k) == str(v) for (k, v) in (filters or {}).items())]
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("directory", help="partitioned <dataset>-YYYYMMDD output")
+    p.add_argument("filters", nargs='*', help="KEY=VALUE, partitions to list")
+
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    filters = dict(f.split('=', 1) for f in args.filters)
+    for entry in select(args.directory, filters):
+        print("%s\t%d" % (os.path.join(args.directory, entry["path"]), entry["rows"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import sys
+
+
+# A sampo pivot url split into its row/column/filter selectors. A
+# dimension selected twice (cov_vac_age) is named with a running number
+# after the first, as in the response.
+class Query:
+
+    def __init__(self, url):
+        (self.base, query) = url.split('?', 1)
+        self.params = []
+        seen = {}
+        for part in query.split('&'):
+            (axis, value) = part.split('=', 1)
+            (dimension, token) = value.rsplit('-', 1)
+            n = seen.get(dimension, 0)
+            seen[dimension] = n + 1
+            self.params.append([axis, dimension, dimension + (str(n) if n else ''), token])
+
+    def url(self):
+        return "%s?%s" % (self.base, "&".join("%s=%s-%s" % (axis, dimension, token)
+                                              for (axis, dimension, name, token) in self.params))
+
+    def filters(self):
+        return sorted((d, t) for (axis, d, name, t) in self.params if axis == 'filter')
+
+    def dimensions(self):
+        return [p for p in self.params if p[0] != 'filter']
+
+
+def ids(token):
+    return [i for i in token.split('.') if i]
+
+
+# A dotted token lists categories one by one; a single id may be a node
+# that expands to its children, so it is only merged into a list that
+# already names it.
+def mergetokens(a, b):
+    if a == b:
+        return a
+    if '.' in a and '.' in b:
+        merged = ids(a) + [i for i in ids(b) if i not in ids(a)]
+        return ".".join(merged) + ("." if a.endswith('.') or b.endswith('.') else "")
+    if '.' in a and b in ids(a):
+        return a
+    if '.' in b and a in ids(b):
+        return b
+    return None
+
+
+def addid(token, id):
+    if id in ids(token):
+        return token
+    return token + id + "." if token.endswith('.') else token + "." + id
+
+
+# Datasets that are slices of one cube request. The first (largest)
+# dataset's query grows into the superset as others are added.
+class Group:
+
+    def __init__(self, ds, totals):
+        self.query = Query(ds.url)
+        self.members = [(ds, Query(ds.url))]
+        self.totals = totals
+
+    # adds ds if its selection can be cut out of the group's request: the
+    # same cube and filters, its dimensions a subsequence of the group's on
+    # the same axes, mergeable selectors, and for every dimension it does
+    # not select a known total category
+    def add(self, ds):
+        query = Query(ds.url)
+        if query.base != self.query.base or query.filters() != self.query.filters():
+            return False
+        dimensions = self.query.dimensions()
+        names = [name for (axis, d, name, token) in dimensions]
+        position = -1
+        for (axis, d, name, token) in query.dimensions():
+            if name not in names or names.index(name) < position or dimensions[names.index(name)][0] != axis:
+                return False
+            position = names.index(name)
+
+        selected = {name: token for (axis, d, name, token) in query.dimensions()}
+        tokens = {}
+        for (axis, d, name, token) in dimensions:
+            if name in selected:
+                tokens[name] = mergetokens(token, selected[name])
+            elif d in self.totals and '.' in token:
+                tokens[name] = addid(token, self.totals[d])
+            else:
+                tokens[name] = None
+            if tokens[name] is None:
+                return False
+
+        for param in dimensions:
+            param[3] = tokens[param[2]]
+        self.members.append((ds, query))
+        return True
+
+    # (select, drop) for Parser.slice that cuts query out of the group's cube
+    def slicing(self, query):
+        selected = {name: token for (axis, d, name, token) in query.dimensions()}
+        select = {}
+        drop = []
+        for (axis, d, name, token) in self.query.dimensions():
+            if name not in selected:
+                select[name] = ({self.totals[d]}, True)
+                drop.append(name)
+            elif selected[name] != token:
+                own = set(ids(selected[name]))
+                if selected[name].endswith('.'):
+                    # whatever else the trailing dot brings in stays
+                    select[name] = (set(ids(token)) - own, False)
+                else:
+                    select[name] = (own, True)
+        return select, drop
+
+    # yields the datasets with their parser set to their slice of the shared
+    # cube, which is fetched and decoded once
+    def datasets(self):
+        if len(self.members) == 1:
+            yield self.members[0][0]
+            return
+
+        shared = self.members[0][0].load(self.query.url())
+        for (ds, query) in self.members:
+            (select, drop) = self.slicing(query)
+            try:
+                with ds.metrics.stage('slice'):
+                    ds.parser = shared.slice(select, drop) if select else shared
+            except ValueError as e:
+                print("%s: %s, fetching it separately" % (ds.name, e), file=sys.stderr)
+                ds.parser = None
+            yield ds
+            ds.parser = None
+
+
+# Groups datasets so that each cube is requested once for all of the
+# datasets it can serve. totals maps a dimension to the category that
+# stands for all of it.
+def plan(datasets, totals):
+    groups = []
+    for ds in sorted(datasets, key=lambda ds: -len(Query(ds.url).dimensions())):
+        for group in groups:
+            if group.add(ds):
+                break
+        else:
+            groups.append(Group(ds, totals))
+    return groups
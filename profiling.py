@@ -0,0 +1,155 @@
+import sys, os, signal, marshal, collections
+
+interval = 0.005
+
+# trace stacks deeper than this are cut, their time counted at the cut
+maxdepth = 64
+# call paths under this fraction of the traced time are not followed,
+# a flame graph could not show them anyway
+minshare = 0.0001
+
+
+# samples the main thread stack on SIGPROF, i.e. every interval of cpu time
+class Sampler:
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.previous = None
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        if stack:
+            self.stacks[tuple(reversed(stack))] += 1
+
+    def start(self):
+        self.previous = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous)
+
+
+def funckey(code):
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def funclabel(code):
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def writefolded(stacks, path):
+    with open(path, 'w') as fp:
+        for (stack, count) in stacks.most_common():
+            print("%s %d" % (";".join(funclabel(code) for code in stack), count), file=fp)
+
+
+# builds the marshalled dict pstats.Stats reads from the samples,
+# sample counts stand in for call counts
+def samplestats(stacks, interval):
+    stats = {}
+    for (stack, count) in stacks.items():
+        seconds = count * interval
+        seen = set()
+        for (i, code) in enumerate(stack):
+            func = funckey(code)
+            (cc, nc, tt, ct, callers) = stats.get(func, (0, 0, 0.0, 0.0, {}))
+            if i == len(stack) - 1:
+                tt += seconds
+            if func not in seen:
+                cc += count
+                nc += count
+                ct += seconds
+                seen.add(func)
+            if i > 0:
+                caller = funckey(stack[i-1])
+                (cnc, ccc, ctt, cct) = callers.get(caller, (0, 0, 0.0, 0.0))
+                callers[caller] = (cnc + count, ccc + count, ctt + (seconds if i == len(stack) - 1 else 0.0), cct + seconds)
+            stats[func] = (cc, nc, tt, ct, callers)
+    return stats
+
+
+# collapsed stacks from the call graph of cProfile stats: each function's
+# own time is split over its callers in proportion to the time they spent
+# in it, walking down from the functions nobody called; the weights are
+# microseconds. The walk is bounded by maxdepth and minshare, as the
+# paths through shared callees multiply with every level.
+def tracestacks(stats):
+    callees = collections.defaultdict(dict)
+    for (func, (cc, nc, tt, ct, callers)) in stats.items():
+        for (caller, (cnc, ccc, ctt, cct)) in callers.items():
+            callees[caller][func] = cct
+
+    roots = [func for (func, (cc, nc, tt, ct, callers)) in stats.items() if not callers]
+    smallest = sum(stats[func][3] for func in roots) * minshare
+    stacks = collections.Counter()
+
+    def walk(func, stack, share):
+        (cc, nc, tt, ct, callers) = stats[func]
+        stack = stack + (func,)
+        if len(stack) >= maxdepth:
+            stacks[stack] += int(ct * share * 1000000)
+            return
+        weight = int(tt * share * 1000000)
+        if weight:
+            stacks[stack] += weight
+        for (callee, cct) in callees[func].items():
+            total = stats[callee][3]
+            if callee not in stack and total:
+                part = share * min(1.0, cct / total)
+                if total * part >= smallest:
+                    walk(callee, stack, part)
+
+    for func in roots:
+        walk(func, (), 1.0)
+    return stacks
+
+
+def statlabel(func):
+    (filename, line, name) = func
+    if filename == '~':
+        # builtins
+        return name
+    return "%s (%s:%d)" % (name, os.path.basename(filename), line)
+
+
+# runs func(*args) under the profiler when mode is 'trace' or 'sample' and
+# writes <outputfile without extension>.prof and .folded; tracing builds
+# both from cProfile, sampling from the SIGPROF samples
+def profile(mode, outputfile, func, *args):
+    if not mode:
+        return func(*args)
+
+    basename = os.path.splitext(outputfile)[0]
+    if mode == 'trace':
+        import cProfile, pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return func(*args)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(basename + ".prof")
+            stacks = tracestacks(pstats.Stats(profiler).stats)
+            with open(basename + ".folded", 'w') as fp:
+                for (stack, weight) in stacks.most_common():
+                    print("%s %d" % (";".join(statlabel(f) for f in stack), weight), file=fp)
+
+    sampler = Sampler(interval)
+    sampler.start()
+    try:
+        return func(*args)
+    finally:
+        sampler.stop()
+        if sampler.stacks:
+            with open(basename + ".prof", 'wb') as fp:
+                marshal.dump(samplestats(sampler.stacks, interval), fp)
+            writefolded(sampler.stacks, basename + ".folded")
+        else:
+            # pstats cannot load an empty dump
+            print("no stack samples (one per %d ms of cpu time), %s.prof not written" % (interval * 1000, basename),
+                  file=sys.stderr)
@@ -0,0 +1,60 @@
+import os, re, datetime
+
+# fields that identify a record within one day's output, per record type
+naturalkeys = {
+    # thldata
+    "area": ("week", "area"),
+    "municipality": ("area",),
+    "demography": (),
+    "deathdemography": (),
+    "ageweeks": ("week",),
+    "tests": ("date",),
+    "infection": ("date", "area"),
+    "deaths": ("date",),
+    "hospital": ("date", "area"),
+    # vaxdata
+    "vaxweek": ("week", "area", "dose"),
+    "vaxcoverage": ("area", "dose"),
+    "vaxpopulation": ("area",),
+    "vaxproduct": ("week", "area", "product", "dose"),
+    "vaxproductarea": ("area", "product", "dose"),
+    "vaxmunicipalities": ("area", "dose"),
+    "vaxdays": ("date", "product"),
+    "vaxareadays": ("date", "area"),
+    # ttrdata
+    "ttrages": ("area", "time", "sex"),
+    # womparser
+    "countrydata": ("date", "country"),
+    "detaildata": ("country",),
+    "populationdata": ("country",),
+}
+
+filenamepattern = re.compile(r"^(.*)-(\d{8})\.[a-z]+$")
+
+
+def keyfields(recordtype):
+    if recordtype in naturalkeys:
+        return naturalkeys[recordtype]
+    # vaxincdata types are named after the dataset
+    if recordtype.startswith(('vaxstat', 'vaxinc')):
+        return ("month",)
+    raise KeyError("no natural key for record type %s" % recordtype)
+
+
+# the fields of a record type in output order: the natural key, then the
+# others sorted; names may repeat
+def fieldorder(recordtype, names):
+    keys = list(keyfields(recordtype))
+    return keys + sorted(set(names) - set(keys))
+
+
+def recordkey(record):
+    return tuple(record.get(field) for field in keyfields(record['type']))
+
+
+# "vaxweeks-20221208.json" -> ("vaxweeks", date(2022, 12, 8))
+def parsefilename(path):
+    m = filenamepattern.match(os.path.basename(path))
+    if not m:
+        raise ValueError("%s is not a <dataset>-YYYYMMDD file" % path)
+    return m.group(1), datetime.datetime.strptime(m.group(2), "%Y%m%d").date()
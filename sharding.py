@@ -0,0 +1,80 @@
+import io, json, multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+
+from metrics import Metrics
+from sinks import Sink
+
+# (dataset, shards), set before the workers are forked so they inherit the
+# decoded cube instead of receiving it pickled
+job = None
+
+
+def runshard(index):
+    (ds, shards) = job
+    ds.metrics = Metrics(ds.name)
+    ds.shardkeys = shards[index]
+    buf = io.StringIO()
+    ds.run(buf)
+    ds.finish(buf)
+    data = buf.getvalue().encode('utf-8')
+
+    # the block is registered with the parent's resource tracker, the parent
+    # unlinks it once it has written it out
+    shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    shm.buf[:len(data)] = data
+    shm.close()
+    return shm.name, len(data), ds.metrics.counters
+
+
+def unlink(name):
+    shm = shared_memory.SharedMemory(name=name)
+    shm.close()
+    shm.unlink()
+
+
+def write(ds, output, name, size):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        with shm.buf[:size] as view:
+            text = str(view, 'utf-8')
+    finally:
+        shm.close()
+        shm.unlink()
+
+    with ds.metrics.stage('write'):
+        if isinstance(output, Sink):
+            for line in text.splitlines():
+                output.write(json.loads(line))
+        else:
+            output.write(text)
+
+
+# Decodes and combines the shards of ds.parser on a pool of forked
+# processes and writes their output in shard order. If a shard or a write
+# fails, the blocks of the shards that finished are unlinked before the
+# error is raised.
+def run(ds, output, jobs):
+    global job
+    shards = ds.parser.shards(jobs, ds)
+    job = (ds, shards)
+    # started before the fork, so the workers register their blocks with it
+    resource_tracker.ensure_running()
+    context = multiprocessing.get_context('fork')
+    try:
+        with context.Pool(min(jobs, len(shards))) as pool:
+            results = [pool.apply_async(runshard, (i,)) for i in range(len(shards))]
+            written = 0
+            try:
+                for result in ds.metrics.timed('shards', results, 'shards'):
+                    (name, size, counters) = result.get()
+                    written += 1
+                    write(ds, output, name, size)
+                    for (counter, n) in counters.items():
+                        ds.metrics.count(counter, n)
+            finally:
+                for result in results[written:]:
+                    result.wait()
+                    if result.successful():
+                        unlink(result.get()[0])
+    finally:
+        job = None
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+
+import sys, os, abc, csv, json, argparse, contextlib, queue, threading
+
+from records import keyfields
+
+
+# Output that takes records as dicts instead of json lines. The dataset
+# run methods write through writerecord() so they can be given either an
+# open file or a Sink.
+class Sink(abc.ABC):
+
+    @abc.abstractmethod
+    def write(self, values):
+        pass
+
+    def close(self):
+        pass
+
+
+def writerecord(output, record):
+    if isinstance(output, ThreadedSink):
+        output.put(record)
+    elif isinstance(output, Sink):
+        output.write(record.values())
+    else:
+        print(record.tojson(), file=output)
+
+
+# Encodes and writes the records of a file output or a CSVSink in a
+# thread, so the writes overlap the decoding. Records are queued in
+# chunks; a full queue makes the producer wait, and an error in the writer
+# is raised on the next chunk or on close. Text written with write() (the
+# json lines of a sharded run) goes out as it is, in order with the
+# records, or line by line as dicts to a CSVSink.
+class ThreadedSink:
+
+    def __init__(self, output, chunksize=2000, depth=8):
+        self.output = output
+        self.chunksize = chunksize
+        self.chunk = []
+        self.queue = queue.Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        self.chunk.append(item)
+        if len(self.chunk) >= self.chunksize:
+            self.flush()
+
+    def write(self, text):
+        self.put(text)
+
+    def flush(self):
+        if self.error is not None:
+            raise self.error
+        if self.chunk:
+            self.queue.put(self.chunk)
+            self.chunk = []
+
+    def writer(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            if self.error is not None:
+                # keep taking chunks so the producer is not blocked
+                continue
+            try:
+                self.writechunk(chunk)
+            except BaseException as e:
+                self.error = e
+
+    def writechunk(self, chunk):
+        if not isinstance(self.output, Sink):
+            self.output.write("".join(item if isinstance(item, str) else item.tojson() + "\n"
+                                      for item in chunk))
+            return
+        for item in chunk:
+            if isinstance(item, str):
+                for line in item.splitlines():
+                    self.output.write(json.loads(line))
+            else:
+                self.output.write(item.values())
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.stop()
+        if self.error is not None:
+            raise self.error
+
+
+# output itself, or a ThreadedSink writing to it if enabled; other Sinks
+# than CSVSink are written to as they are (a sqlite connection stays in
+# the thread that opened it)
+@contextlib.contextmanager
+def pipeline(output, enabled=True):
+    if not enabled or (isinstance(output, Sink) and not isinstance(output, CSVSink)):
+        yield output
+        return
+    sink = ThreadedSink(output)
+    try:
+        yield sink
+    except BaseException:
+        sink.stop()
+        raise
+    sink.close()
+
+
+# writes to path.tmp and renames it over path only when the run succeeds,
+# so a failed fetch never leaves a partial file that looks like a result
+@contextlib.contextmanager
+def atomicfile(path):
+    tmpfile = path + ".tmp"
+    try:
+        with open(tmpfile, 'w') as fp:
+            yield fp
+    except BaseException:
+        os.unlink(tmpfile)
+        raise
+    os.replace(tmpfile, path)
+
+
+def sqltype(value):
+    if isinstance(value, (bool, int)):
+        return "integer"
+    elif isinstance(value, float):
+        return "real"
+    return "text"
+
+
+def sqlvalue(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+# Writes the records as csv to a text output. The columns are fields(),
+# the fields the dataset declares for its records (e.g. THLData.fields),
+# asked for when the first record is written so that a cube is loaded by
+# then; the header goes out first and the rows follow in batches. None
+# and missing fields are empty, lists and dicts json.
+class CSVSink(Sink):
+
+    def __init__(self, output, fields, batchsize=5000):
+        self.fields = fields
+        self.batchsize = batchsize
+        self.index = None
+        self.batch = []
+        self.writer = csv.writer(output, lineterminator="\n")
+
+    def writeheader(self):
+        columns = list(self.fields())
+        self.index = {k: i for (i, k) in enumerate(columns)}
+        self.writer.writerow(columns)
+
+    def write(self, values):
+        if self.index is None:
+            self.writeheader()
+        row = [None] * len(self.index)
+        for (k, v) in values.items():
+            if k not in self.index:
+                raise ValueError("field %s of a %s record is not in the csv header" % (k, values.get('type')))
+            row[self.index[k]] = sqlvalue(v)
+        self.batch.append(row)
+        if len(self.batch) >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        self.writer.writerows(self.batch)
+        self.batch = []
+
+    def close(self):
+        if self.index is None:
+            self.writeheader()
+        self.flush()
+
+    def discard(self):
+        self.batch = []
+
+
+# a CSVSink of fields writing to fp if enabled, otherwise fp
+@contextlib.contextmanager
+def csvoutput(fp, fields, enabled=True):
+    if not enabled:
+        yield fp
+        return
+    sink = CSVSink(fp, fields)
+    try:
+        yield sink
+    except BaseException:
+        sink.discard()
+        raise
+    sink.close()
+
+
+# an SQLiteSink that is closed (and indexed) however the load ends
+@contextlib.contextmanager
+def sqliteoutput(path):
+    sink = SQLiteSink(path)
+    try:
+        yield sink
+    finally:
+        sink.close()
+
+
+# Runs process(output) with the output the command line options ask for:
+# a --partitioned directory (keyed by partitionby unless --partition-by
+# is given), a --sqlite database, stdout or outputfile, as csv with -C and
+# from a writer thread with --pipeline. An existing output is kept unless
+# --overwrite is given; reuse is entered around the writing of a file
+# (THLData.reusing). fields gives the csv columns (CSVSink). Returns False
+# if nothing was written.
+def writeoutput(options, outputfile, process, partitionby=(), reuse=None, fields=None):
+    threaded = getattr(options, 'pipeline', False)
+    if getattr(options, 'partitioned', False):
+        from partitions import partitioned, partitionkeys
+        directory = os.path.splitext(outputfile)[0]
+        if os.path.exists(directory) and not options.overwrite:
+            print("%s exists" % directory)
+            return False
+        with partitioned(directory, partitionkeys(options.partitionby, partitionby)) as sink:
+            process(sink)
+    elif options.sqlite:
+        with sqliteoutput(options.sqlite) as sink:
+            process(sink)
+    elif options.write_stdout:
+        with csvoutput(sys.stdout, fields, options.csv) as sink, pipeline(sink, threaded) as out:
+            process(out)
+    else:
+        if os.path.exists(outputfile) and os.path.getsize(outputfile) > 0 and not options.overwrite:
+            print("%s exists" % outputfile)
+            return False
+        with reuse or contextlib.nullcontext(), atomicfile(outputfile) as fp, \
+                csvoutput(fp, fields, options.csv) as sink, pipeline(sink, threaded) as out:
+            process(out)
+    return True
+
+
+def quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+# the natural key columns as indexed, a missing key field is '' so that
+# records without it are updated like the others instead of added again
+def keyexpressions(keys):
+    return ", ".join("coalesce(%s, '')" % quote(k) for k in keys)
+
+
+class SQLiteSink(Sink):
+    # columns indexed after the load if the table has them
+    indexfields = ("area", "date", "week", "month", "country")
+
+    def __init__(self, path, batchsize=5000):
+        import sqlite3
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("pragma synchronous=normal")
+        self.batchsize = batchsize
+        self.pending = {}
+        self.columns = {}
+        self.statements = {}
+
+    def write(self, values):
+        recordtype = values['type']
+        batch = self.pending.setdefault(recordtype, [])
+        batch.append(values)
+        if len(batch) >= self.batchsize:
+            self.flush(recordtype)
+
+    def keycolumns(self, recordtype):
+        # a type without a natural key has one row, replaced on every load
+        return keyfields(recordtype) or ("type",)
+
+    def preparetable(self, recordtype, batch):
+        columns = self.columns.get(recordtype)
+        if columns is None:
+            columns = [row[1] for row in self.db.execute("pragma table_info(%s)" % quote(recordtype))]
+            self.columns[recordtype] = columns
+            if columns:
+                self.createkeyindex(recordtype)
+
+        types = {}
+        for values in batch:
+            for (k, v) in values.items():
+                if types.get(k) is None:
+                    types[k] = sqltype(v) if v is not None else None
+        types = {k: t or "text" for (k, t) in types.items()}
+
+        keys = self.keycolumns(recordtype)
+        if not columns:
+            names = list(keys) + sorted(k for k in types if k not in keys)
+            self.db.execute("create table %s (%s)" % (
+                quote(recordtype), ", ".join("%s %s" % (quote(k), types.get(k, "text")) for k in names)))
+            self.createkeyindex(recordtype)
+            columns.extend(names)
+            self.statements.pop(recordtype, None)
+        else:
+            for k in sorted(types):
+                if k not in columns:
+                    self.db.execute("alter table %s add column %s %s" % (quote(recordtype), quote(k), types[k]))
+                    columns.append(k)
+                    self.statements.pop(recordtype, None)
+        return columns
+
+    # Tables from before the key index used coalesce() have an index on the
+    # plain columns, with a row for every load of a record with a null key
+    # field; only the last of those is kept. An index on an older natural
+    # key of the type is replaced the same way.
+    def createkeyindex(self, recordtype):
+        name = recordtype + "_key"
+        row = self.db.execute("select sql from sqlite_master where type = 'index' and name = ?", (name,)).fetchone()
+        expressions = keyexpressions(self.keycolumns(recordtype))
+        if row and row[0].endswith("(%s)" % expressions):
+            return
+        if row:
+            self.db.execute("drop index %s" % quote(name))
+            self.db.execute("delete from %s where rowid not in (select max(rowid) from %s group by %s)" % (
+                quote(recordtype), quote(recordtype), expressions))
+        self.db.execute("create unique index %s on %s (%s)" % (quote(name), quote(recordtype), expressions))
+
+    def statement(self, recordtype, columns):
+        if recordtype not in self.statements:
+            keys = self.keycolumns(recordtype)
+            updates = [k for k in columns if k not in keys]
+            self.statements[recordtype] = "insert into %s (%s) values (%s) on conflict (%s) do %s" % (
+                quote(recordtype),
+                ", ".join(quote(k) for k in columns),
+                ", ".join("?" for k in columns),
+                keyexpressions(keys),
+                "update set " + ", ".join("%s = excluded.%s" % (quote(k), quote(k)) for k in updates) if updates else "nothing",
+            )
+        return self.statements[recordtype]
+
+    def flush(self, recordtype):
+        batch = self.pending.pop(recordtype, [])
+        if not batch:
+            return
+        self.db.execute("begin")
+        try:
+            columns = self.preparetable(recordtype, batch)
+            rows = [tuple(sqlvalue(values.get(k)) for k in columns) for values in batch]
+            self.db.executemany(self.statement(recordtype, columns), rows)
+            self.db.execute("commit")
+        except BaseException:
+            self.db.execute("rollback")
+            raise
+
+    def close(self):
+        for recordtype in list(self.pending):
+            self.flush(recordtype)
+        for (recordtype, columns) in self.columns.items():
+            for field in self.indexfields:
+                if field in columns and field not in self.keycolumns(recordtype)[:1]:
+                    self.db.execute("create index if not exists %s on %s (%s)" % (
+                        quote("%s_%s" % (recordtype, field)), quote(recordtype), quote(field)))
+        self.db.close()
+
+
+def load(sink, filename):
+    n = 0
+    with open(filename) as fp:
+        for line in fp:
+            if line.strip():
+                sink.write(json.loads(line))
+                n += 1
+    return n
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("database", help="sqlite database")
+    p.add_argument("files", nargs='+', help="<dataset>-YYYYMMDD.json files")
+
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    with sqliteoutput(args.database) as sink:
+        for filename in args.files:
+            print(filename, load(sink, filename))
+
+
+if __name__ == "__main__":
+    main()
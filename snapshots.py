@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import os, json, hashlib, sqlite3, argparse
+
+from records import recordkey, parsefilename
+
+storedir = 'snapshots'
+
+schema = """
+create table if not exists revisions (
+    dataset text not null,
+    key text not null,
+    datadate text not null,
+    hash text not null,
+    offset integer not null,
+    length integer not null,
+    primary key (dataset, key, datadate)
+);
+create index if not exists revisions_datadate on revisions (dataset, datadate);
+create table if not exists releases (
+    dataset text not null,
+    datadate text not null,
+    filename text not null,
+    records integer not null,
+    changed integer not null,
+    primary key (dataset, datadate)
+);
+"""
+
+
+def contenthash(record):
+    values = {k: v for (k, v) in record.items() if k != 'datadate'}
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# Daily outputs are stored as revisions: a record is appended to the
+# dataset log only when it differs from the previous release of the same
+# natural key, and the index maps (dataset, key, datadate) to its offset.
+# A key missing from a release gets a tombstone revision (hash '', offset
+# -1). Releases are ingested in date order, as each is compared with the
+# one before.
+class SnapshotStore:
+
+    def __init__(self, path=storedir):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, 'index.db'))
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def logfile(self, dataset):
+        return os.path.join(self.path, "%s.jsonl" % dataset)
+
+    def previous(self, dataset, datadate):
+        rows = self.db.execute(
+            "select key, hash from revisions r where dataset = ? and datadate = "
+            "(select max(datadate) from revisions where dataset = r.dataset and key = r.key and datadate < ?)",
+            (dataset, datadate))
+        return dict(rows)
+
+    def ingest(self, filename):
+        (dataset, date) = parsefilename(filename)
+        datadate = str(date)
+        if self.db.execute("select 1 from releases where dataset = ? and datadate = ?",
+                           (dataset, datadate)).fetchone():
+            return 0, 0
+        (newest,) = self.db.execute("select max(datadate) from releases where dataset = ?", (dataset,)).fetchone()
+        if newest and datadate < newest:
+            raise ValueError("%s is older than the newest %s release %s" % (filename, dataset, newest))
+
+        previous = self.previous(dataset, datadate)
+        rows = []
+        records = 0
+        with open(filename) as fp, open(self.logfile(dataset), 'ab') as log:
+            for line in fp:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                records += 1
+                key = json.dumps(recordkey(record), ensure_ascii=False)
+                h = contenthash(record)
+                if previous.pop(key, None) == h:
+                    continue
+                data = line.rstrip('\n').encode('utf-8') + b'\n'
+                rows.append((dataset, key, datadate, h, log.tell(), len(data)))
+                log.write(data)
+        # keys left in previous were removed in this release
+        rows.extend((dataset, key, datadate, '', -1, 0) for (key, h) in previous.items() if h)
+
+        with self.db:
+            self.db.executemany("insert or replace into revisions values (?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute("insert into releases values (?, ?, ?, ?, ?)",
+                            (dataset, datadate, os.path.basename(filename), records, len(rows)))
+        return records, len(rows)
+
+    # the records at locations, tombstones are left out
+    def read(self, dataset, locations):
+        records = []
+        with open(self.logfile(dataset), 'rb') as log:
+            for (datadate, offset, length) in locations:
+                if offset < 0:
+                    continue
+                log.seek(offset)
+                record = json.loads(log.read(length))
+                record['datadate'] = datadate
+                records.append(record)
+        return records
+
+    def asof(self, dataset, key, date):
+        locations = self.db.execute(
+            "select datadate, offset, length from revisions where dataset = ? and key = ? and datadate <= ? "
+            "order by datadate desc limit 1",
+            (dataset, json.dumps(list(key), ensure_ascii=False), str(date))).fetchall()
+        records = self.read(dataset, locations)
+        return records[0] if records else None
+
+    # every key as it was on date
+    def snapshot(self, dataset, date):
+        locations = self.db.execute(
+            "select max(datadate), offset, length from revisions where dataset = ? and datadate <= ? "
+            "group by key order by offset",
+            (dataset, str(date))).fetchall()
+        return self.read(dataset, locations)
+
+    def history(self, dataset, key, start=None, end=None):
+        locations = self.db.execute(
+            "select datadate, offset, length from revisions where dataset = ? and key = ? "
+            "and datadate >= ? and datadate <= ? order by datadate",
+            (dataset, json.dumps(list(key), ensure_ascii=False), str(start or ''), str(end or '9999'))).fetchall()
+        return self.read(dataset, locations)
+
+    def releases(self, dataset, start=None, end=None):
+        return self.db.execute(
+            "select datadate, filename, records, changed from releases where dataset = ? "
+            "and datadate >= ? and datadate <= ? order by datadate",
+            (dataset, str(start or ''), str(end or '9999'))).fetchall()
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "-S",
+        "--store",
+        action="store",
+        dest="store",
+        default=storedir,
+        help="snapshot store directory",
+    )
+    p.add_argument(
+        "--since",
+        action="store",
+        dest="since",
+        default=None,
+        help="first datadate (YYYY-MM-DD)",
+    )
+    p.add_argument(
+        "--until",
+        action="store",
+        dest="until",
+        default=None,
+        help="last datadate (YYYY-MM-DD)",
+    )
+    p.add_argument("cmd", choices=['ingest', 'asof', 'history', 'releases'])
+    p.add_argument("args", nargs='*', help="ingest: files; asof: dataset date [key...]; history: dataset key...; releases: dataset")
+
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    store = SnapshotStore(args.store)
+
+    if args.cmd == 'ingest':
+        # older releases first so revisions are compared in order
+        for filename in sorted(args.args, key=lambda f: parsefilename(f)[1]):
+            try:
+                (records, changed) = store.ingest(filename)
+            except ValueError as e:
+                print(e)
+                continue
+            print("%s: %d records, %d changed" % (filename, records, changed))
+
+    elif args.cmd == 'asof':
+        (dataset, date, key) = (args.args[0], args.args[1], args.args[2:])
+        if key:
+            records = [store.asof(dataset, key, date)]
+        else:
+            records = store.snapshot(dataset, date)
+        for record in records:
+            if record:
+                print(json.dumps(record, sort_keys=True, ensure_ascii=False))
+
+    elif args.cmd == 'history':
+        (dataset, key) = (args.args[0], args.args[1:])
+        for record in store.history(dataset, key, args.since, args.until):
+            print(json.dumps(record, sort_keys=True, ensure_ascii=False))
+
+    elif args.cmd == 'releases':
+        for (datadate, filename, records, changed) in store.releases(args.args[0], args.since, args.until):
+            print(datadate, filename, records, changed)
+
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
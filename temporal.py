@@ -0,0 +1,93 @@
+import datetime
+
+# Labels of the sampo time dimensions: days ("2021-03-01"), weeks
+# ("Vuoden 2021 viikko 12") and months ("maaliskuu 2022"). A label is
+# resolved to an ISO date (the monday of a week, YYYY-MM for a month) and
+# the ordinal of its first day; totals like "Kaikki ajat" resolve to None.
+
+months = [
+    'tammikuu',
+    'helmikuu',
+    'maaliskuu',
+    'huhtikuu',
+    'toukokuu',
+    'kesäkuu',
+    'heinäkuu',
+    'elokuu',
+    'syyskuu',
+    'lokakuu',
+    'marraskuu',
+    'joulukuu',
+]
+
+# names of the time dimensions, the dateweek ones are followed by their
+# start date (dateweek20200101)
+prefixes = ('dateweek', 'quadrimestermonth')
+
+
+def istime(dimension):
+    return dimension.startswith(prefixes)
+
+
+def decode(label):
+    parts = label.split()
+    try:
+        if len(parts) == 4 and parts[0] == 'Vuoden' and parts[2] == 'viikko':
+            day = datetime.date.fromisocalendar(int(parts[1]), int(parts[3]), 1)
+            return str(day), day.toordinal()
+        if len(parts) == 2 and parts[0] in months:
+            day = datetime.date(int(parts[1]), months.index(parts[0]) + 1, 1)
+            return day.strftime('%Y-%m'), day.toordinal()
+        if len(parts) == 1:
+            day = datetime.date.fromisoformat(label)
+            return str(day), day.toordinal()
+    except ValueError:
+        pass
+    return None, None
+
+
+# the ordinal of the last day of a label's week, month or day
+def lastday(label):
+    (iso, ordinal) = decode(label)
+    if ordinal is None:
+        return None
+    if label.startswith('Vuoden'):
+        return ordinal + 6
+    if len(iso) == 7:
+        day = datetime.date.fromordinal(ordinal)
+        following = datetime.date(day.year + day.month // 12, day.month % 12 + 1, 1)
+        return following.toordinal() - 1
+    return ordinal
+
+
+# the kind of a label's period ('week', 'month' or 'day') and its number
+# counted in periods of that kind, (None, None) for totals
+def period(label):
+    (iso, ordinal) = decode(label)
+    if ordinal is None:
+        return None, None
+    if label.startswith('Vuoden'):
+        # mondays are the ordinals 7n + 1
+        return 'week', (ordinal - 1) // 7
+    if len(iso) == 7:
+        day = datetime.date.fromordinal(ordinal)
+        return 'month', day.year * 12 + day.month - 1
+    return 'day', ordinal
+
+
+# the label of a period, the inverse of period()
+def label(kind, number):
+    if kind == 'week':
+        (year, week, _) = datetime.date.fromordinal(number * 7 + 1).isocalendar()
+        return "Vuoden %d viikko %d" % (year, week)
+    if kind == 'month':
+        return "%s %d" % (months[number % 12], number // 12)
+    return str(datetime.date.fromordinal(number))
+
+
+def lastdays(labels):
+    return [lastday(label) for label in labels]
+
+
+def isodates(labels):
+    return [decode(label)[0] for label in labels]
@@ -0,0 +1,47 @@
+import os, json, tempfile, unittest
+
+from snapshots import SnapshotStore
+
+
+class SnapshotStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.store = SnapshotStore(os.path.join(self.dir.name, 'store'))
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    def release(self, date, areas):
+        filename = os.path.join(self.dir.name, 'kunnat-%s.json' % date.replace('-', ''))
+        with open(filename, 'w') as fp:
+            for (area, cases) in areas.items():
+                print(json.dumps(dict(type='municipality', area=area, cases=cases, datadate=date)), file=fp)
+        return filename
+
+    def test_deleted_key(self):
+        self.store.ingest(self.release('2022-01-01', {'A': 1, 'B': 2}))
+        self.store.ingest(self.release('2022-01-02', {'A': 1}))
+
+        self.assertEqual([r['area'] for r in self.store.snapshot('kunnat', '2022-01-01')], ['A', 'B'])
+        self.assertEqual([r['area'] for r in self.store.snapshot('kunnat', '2022-01-02')], ['A'])
+        self.assertEqual(self.store.asof('kunnat', ('B',), '2022-01-01')['cases'], 2)
+        self.assertIsNone(self.store.asof('kunnat', ('B',), '2022-01-02'))
+
+    def test_readded_key(self):
+        self.store.ingest(self.release('2022-01-01', {'A': 1, 'B': 2}))
+        self.store.ingest(self.release('2022-01-02', {'A': 1}))
+        self.store.ingest(self.release('2022-01-03', {'A': 1, 'B': 2}))
+
+        self.assertEqual(self.store.asof('kunnat', ('B',), '2022-01-03')['datadate'], '2022-01-03')
+        self.assertEqual([r['datadate'] for r in self.store.history('kunnat', ('B',))], ['2022-01-01', '2022-01-03'])
+
+    def test_backfill_refused(self):
+        self.store.ingest(self.release('2022-01-02', {'A': 1}))
+        with self.assertRaises(ValueError):
+            self.store.ingest(self.release('2022-01-01', {'A': 1, 'B': 2}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,16 @@
 #!/usr/bin/env python3
 
-import sys, os, json, inspect, optparse, datetime
-import requests
+import sys, os, json, optparse, datetime, itertools, contextlib
+
+from metrics import Metrics, report
+from profiling import profile
+from sinks import writerecord, writeoutput
+from records import keyfields, fieldorder
+from fetching import download
+from values import convert, integers
+from upstream import Upstream, Unchanged
+from derived import Derived, loadpopulation
+import temporal
 
 requestheaders = {'User-Agent': 'thldata'}
 
@@ -78,7 +87,7 @@ class Parser():
         else:
             self.dataset = data["dataset"]
 
-    def parse(self, mapper=None):
+    def loaddimensions(self):
         self.dimensions = [
             Dimension(name, size)
             for (name, size) in zip(
@@ -95,57 +104,324 @@ class Parser():
             values.sort()
             d.categories = [v[1] for v in values]
 
-        values = self.dataset["value"]
-        for v in values.keys():
-            # print(v, values[v])
+        return self.dimensions
+
+    def parse(self, mapper=None, keys=None):
+        self.loaddimensions()
+
+        if keys is None:
+            keys = self.dataset["value"].keys()
+        keys = list(keys)
+        if mapper.since is not None:
+            keys = self.since(keys, mapper.since)
+        values = dict(zip(keys, mapper.convertvalues(self, keys)))
+        # fields and labels are mapped once per dimension, not per cell
+        dimensions = self.dimensions[::-1]
+        fields = [mapper.mapfield(d.name) for d in dimensions]
+        categories = [mapper.mapcategories(d) for d in dimensions]
+        for v in keys:
             idx = int(v)
-            labels = []
             jd = {}
-            for d in self.dimensions[::-1]:
-                # print(d, d.size, idx, d.categories[idx % d.size])
-                label = d.categories[idx % d.size]
-                labels.append(label)
-                jd[mapper.mapfield(d.name)] = mapper.mapvalue(label)
-                idx = int(idx / d.size)
+            for (d, field, labels) in zip(dimensions, fields, categories):
+                jd[field] = labels[idx % d.size]
+                idx = idx // d.size
             jd[mapper.mapfield("value")] = mapper.mapvalue(values[v])
-            # print(labels, values[v])
-            d = ParserData(jd)
-            # print(d.tojson())
-            yield d
+            yield ParserData(jd)
+
+    # the keys of the cells whose day, week or month ends on or after the
+    # date since in every time dimension, cells of a total category are
+    # kept; parse() has loaded the dimensions
+    def since(self, keys, since):
+        start = since.toordinal()
+        stride = 1
+        for d in self.dimensions[::-1]:
+            if temporal.istime(d.name):
+                ends = temporal.lastdays(d.categories)
+                keys = [k for k in keys if (ends[int(k) // stride % d.size] or start) >= start]
+            stride *= d.size
+        return keys
+
+    # Splits the value keys into at most n runs of consecutive categories of
+    # the outermost dimension with about the same number of cells. A run never
+    # ends between two categories the mapper maps to the same label.
+    def shards(self, n, mapper):
+        dimensions = self.loaddimensions()
+        outer = dimensions[0]
+        stride = 1
+        for d in dimensions[1:]:
+            stride *= d.size
+
+        values = self.dataset["value"]
+        counts = [0] * outer.size
+        for v in values.keys():
+            counts[int(v) // stride] += 1
+
+        target = len(values) / n
+        shardof = []
+        shard = 0
+        cells = 0
+        for (i, label) in enumerate(outer.categories):
+            if (cells >= target * (shard + 1) and shard < n - 1
+                    and mapper.mapvalue(label) != mapper.mapvalue(outer.categories[i-1])):
+                shard += 1
+            shardof.append(shard)
+            cells += counts[i]
+
+        keys = [[] for i in range(shard + 1)]
+        for v in values.keys():
+            keys[shardof[int(v) // stride]].append(v)
+        return [k for k in keys if k]
+
+    # A Parser over part of this cube. select maps a dimension id to
+    # (category ids, include): the categories to keep, or with include
+    # False the ones to leave out. Dimensions in drop must be left with one
+    # category and are removed. Raises ValueError if a category to keep is
+    # not in the cube.
+    def slice(self, select, drop=()):
+        dimension = self.dataset["dimension"]
+        newdimension = {"id": [], "size": []}
+        positions = []
+        strides = []
+        stride = 1
+        for (name, size) in reversed(list(zip(dimension["id"], dimension["size"]))):
+            strides.insert(0, stride)
+            stride *= size
+
+        for name in dimension["id"]:
+            category = dimension[name]["category"]
+            index = category["index"]
+            kept = sorted(index, key=index.get)
+            if name in select:
+                (ids, include) = select[name]
+                if include:
+                    missing = set(ids) - set(kept)
+                    if missing:
+                        raise ValueError("%s has no categories %s" % (name, ", ".join(sorted(missing))))
+                kept = [c for c in kept if (c in ids) == include]
+            positions.append([index[c] for c in kept])
+            if name in drop:
+                if len(kept) != 1:
+                    raise ValueError("%s has %d categories, cannot drop it" % (name, len(kept)))
+                continue
+            newdimension["id"].append(name)
+            newdimension["size"].append(len(kept))
+            newdimension[name] = dict(dimension[name], category=dict(
+                category,
+                index={c: i for (i, c) in enumerate(kept)},
+                label={c: category["label"][c] for c in kept},
+            ))
+
+        values = self.dataset["value"]
+        newvalues = {}
+        for (i, cell) in enumerate(itertools.product(*positions)):
+            value = values.get(str(sum(p * s for (p, s) in zip(cell, strides))))
+            if value is not None:
+                newvalues[str(i)] = value
+        return Parser(data={"dataset": dict(self.dataset, dimension=newdimension, value=newvalues)})
 
 
 class THLData():
     name = None
     url = None
+    datatype = None
 
     valuemap = {}
     fieldmap = {}
 
+    # converter from values.py for the cube's cells, None keeps the text;
+    # measuretypes overrides it per (mapped) category of measurefield
+    valuetype = None
+    measuretypes = {}
+    measurefield = "measure"
+
+    # the labels of time dimensions are written as ISO dates (temporal.py)
+    isodates = False
+
+    # keys of the --partitioned output (partitions.py)
+    partitionby = ()
+
+    # measures that --derived adds 7 day sums, incidence and growth for
+    # (derived.py)
+    derivedfields = ()
+
+    def __init__(self):
+        self.metrics = Metrics(self.name)
+        self.jobs = 1
+        self.parser = None
+        self.shardkeys = None
+        self.upstream = None
+        self.since = None
+        self.derived = None
+
     def setdatadate(self, offset = 0):
         self.datadate = datetime.date.today() - datetime.timedelta(days=offset)
 
+    def fetch(self, url, headers=None):
+        with self.metrics.stage('fetch'):
+            return download(url, headers=dict(requestheaders, **(headers or {})))
+
+    def load(self, url=None):
+        url = url or self.url
+        validators = self.upstream.validators(url) if self.upstream else {}
+        with self.fetch(url, validators) as body:
+            self.metrics.count('bytes', len(body))
+            if self.upstream and self.upstream.unchanged(url, body):
+                raise Unchanged(url)
+            with self.metrics.stage('decode'):
+                return Parser(data=body.json())
+
+    def parse(self):
+        if self.parser is None:
+            self.parser = self.load()
+        return self.metrics.timed('parse', self.parser.parse(mapper=self, keys=self.shardkeys), 'cells')
+
+    def emit(self, record, output):
+        if self.derived:
+            # held until the whole dataset is read
+            self.derived.add([record])
+        else:
+            self.write([record], output)
+
+    def write(self, records, output):
+        for record in records:
+            with self.metrics.stage('write'):
+                writerecord(output, record)
+            self.metrics.count('rows')
+
+    # writes the records held by the derived stage after run()
+    def finish(self, output):
+        if self.derived:
+            with self.metrics.stage('derive'):
+                records = self.derived.finish()
+            self.write(records, output)
+
+    # the --derived stage, None if the dataset has no derivedfields; the
+    # series are the natural key without its date or week
+    def derivedstage(self, population=None):
+        if not self.derivedfields:
+            return None
+        keys = keyfields(self.recordtype())
+        datefield = [k for k in keys if k in ("date", "week")][0]
+        return Derived(datefield, [k for k in keys if k != datefield], self.derivedfields, population)
+
+    # the fields of the records run() writes (the csv columns): the natural
+    # key first, then the others sorted
+    def fields(self):
+        if self.parser is None:
+            self.parser = self.load()
+        self.parser.loaddimensions()
+        names = self.recordfields() + ["datadate", "type"]
+        if self.derived:
+            names += self.derived.fieldnames()
+        return fieldorder(self.recordtype(), names)
+
+    # the fields of the records besides datadate and type, by default a
+    # field per dimension and the value
+    def recordfields(self):
+        return [self.mapfield(d.name) for d in self.parser.dimensions] + [self.mapfield("value")]
+
+    # the (mapped) labels of the dimension mapped to field, [] if there is
+    # none
+    def categories(self, field):
+        for d in self.parser.dimensions:
+            if self.mapfield(d.name) == field:
+                return self.mapcategories(d)
+        return []
+
+    def recordtype(self):
+        if isinstance(self.datatype, str):
+            return self.datatype
+        return self.datatype.type
+
+    # records can be combined per shard if the outermost dimension is part
+    # of the natural key, so no record spans two shards
+    def shardable(self):
+        if self.derived:
+            # a series spans the shards
+            return False
+        outer = self.mapfield(self.parser.dataset["dimension"]["id"][0])
+        return outer in keyfields(self.recordtype())
+
+    def process(self, output):
+        if self.jobs > 1:
+            if self.parser is None:
+                self.parser = self.load()
+            if self.shardable():
+                import sharding
+                return sharding.run(self, output, self.jobs)
+        self.run(output)
+        self.finish(output)
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             ddata = self.datatype(data.values())
             ddata.datadate = str(self.datadate)
-            print(ddata.tojson(), file=output)
+            self.emit(ddata, output)
+
+    # the cells of keys, converted a column per value type
+    def convertvalues(self, parser, keys):
+        values = parser.dataset["value"]
+        column = [values[k] for k in keys]
+        # looked up on the class so the converter is not bound as a method
+        valuetype = type(self).valuetype
+        if not self.measuretypes:
+            return convert(column, valuetype)
+
+        stride = 1
+        for d in parser.dimensions[::-1]:
+            if self.mapfield(d.name) == self.measurefield:
+                break
+            stride *= d.size
+        else:
+            return convert(column, valuetype)
+        types = [self.measuretypes.get(self.mapvalue(label), valuetype) for label in d.categories]
+        celltypes = [types[int(k) // stride % d.size] for k in keys]
+
+        converted = [None] * len(column)
+        for celltype in set(types):
+            cells = [i for (i, t) in enumerate(celltypes) if t is celltype]
+            for (i, value) in zip(cells, convert([column[i] for i in cells], celltype)):
+                converted[i] = value
+        return converted
 
     def mapvalue(self, value):
         return self.valuemap.get(value, value)
 
+    def mapcategories(self, dimension):
+        labels = [self.mapvalue(label) for label in dimension.categories]
+        if self.isodates and temporal.istime(dimension.name):
+            dates = temporal.isodates(dimension.categories)
+            labels = [date or label for (date, label) in zip(dates, labels)]
+        return labels
+
     def mapfield(self, value):
         return self.fieldmap.get(value, value)
 
-    def getfilename(self):
+    def getfilename(self, extension="json"):
         datestr = self.datadate.strftime("%Y%m%d")
-        return "%s-%s.json" % (self.name, datestr)
+        return "%s-%s.%s" % (self.name, datestr, extension)
+
+    # around the writing of outputfile: if the cube has not changed since
+    # the run recorded in the upstream manifest, the previous output is
+    # reused instead (upstream.py)
+    @contextlib.contextmanager
+    def reusing(self, outputfile, rebuild=False):
+        self.upstream = Upstream(os.path.dirname(outputfile), rebuild)
+        self.upstream.allow(self.url, [self.name], self.since)
+        try:
+            yield
+        except Unchanged:
+            print("%s: unchanged since %s" % (self.name, self.upstream.previous(self.name)["datadate"]))
+            self.upstream.reuse(self.name, outputfile, self.datadate)
+            return
+        self.upstream.record(self.name, self.url, outputfile, self.datadate, self.since)
 
 
 class THLKunnat(THLData):
     name = "kunnat"
+    datatype = MunicipalityData
+    valuetype = integers
+    partitionby = ("area",)
     url = "https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19case/fact_epirapo_covid19case.json?column=hcdmunicipality2020-445268L&column=measure-141082"
 
     fieldmap = {
@@ -153,33 +429,33 @@ class THLKunnat(THLData):
         "hcdmunicipality2020": "area",
     }
 
+    def recordfields(self):
+        return ["area", "cases", "population"]
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         lastarea = None
         combined = MunicipalityData()
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             if lastarea and data.area != lastarea:
-                print(combined.tojson(), file=output)
+                self.emit(combined, output)
                 combined = MunicipalityData()
             lastarea = data.area
             combined.area = data.area
             if data.measure == "Tapausten lukumäärä":
-                if data.value != "..":
-                    combined.cases = int(data.value)
-                else:
-                    combined.cases = None
+                combined.cases = data.value
             elif data.measure == "Asukaslukumäärä":
-                combined.population = int(data.value)
+                combined.population = data.value
 
             combined.datadate = str(self.datadate)
 
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
 
 
 class THLAlueet(THLData):
     name = "alueet"
+    datatype = AreaData
+    valuetype = integers
+    partitionby = ("isoyear", "isoweek")
     url = "https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19case/fact_epirapo_covid19case.json?row=dateweek20200101-509030&row=hcdmunicipality2020-445222&column=measure-141082"
 
     fieldmap = {
@@ -193,35 +469,37 @@ class THLAlueet(THLData):
         "Kaikki ajat": "Yhteensä",
     }
 
+    def recordfields(self):
+        return ["week", "area", "cases", "population", "tests", "deaths"]
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         lastweekarea = None
         combined = AreaData()
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             if lastweekarea and (data.week, data.area) != lastweekarea:
-                print(combined.tojson(), file=output)
+                self.emit(combined, output)
                 combined = AreaData()
             lastweekarea = (data.week, data.area)
             combined.week = data.week
             combined.area = data.area
             if data.measure == "Tapausten lukumäärä":
-                combined.cases = int(data.value)
+                combined.cases = data.value
             elif data.measure == "Asukaslukumäärä":
-                combined.population = int(data.value)
+                combined.population = data.value
             elif data.measure == "Testausmäärä":
-                combined.tests = int(data.value)
+                combined.tests = data.value
             elif data.measure == "Kuolemantapausten lukumäärä":
-                combined.deaths = int(data.value)
+                combined.deaths = data.value
 
             combined.datadate = str(self.datadate)
 
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
 
 
 class THLTestit(THLData):
     name = "testit"
+    datatype = TestsData
+    valuetype = integers
     url = "https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19case/fact_epirapo_covid19case.json?row=dateweek20200101-509030L&column=measure-141082"
     fieldmap = {
         "dateweek20200101": "date",
@@ -232,30 +510,32 @@ class THLTestit(THLData):
         "Kaikki Alueet": "Koko maa",
     }
 
+    def recordfields(self):
+        return ["date", "cases", "tests"]
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         lastdate = None
         combined = TestsData()
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             if lastdate and data.date != lastdate:
-                print(combined.tojson(), file=output)
+                self.emit(combined, output)
                 combined = TestsData()
             lastdate = data.date
             combined.date = data.date
             combined.datadate = str(self.datadate)
             if data.measure == "Tapausten lukumäärä":
-                combined.cases = int(data.value)
+                combined.cases = data.value
             elif data.measure == "Testausmäärä":
-                combined.tests = int(data.value)
+                combined.tests = data.value
 
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
 
 
 class THLTartunnat(THLData):
     name = "tartunnat"
     datatype = InfectionData
+    isodates = True
+    derivedfields = ("value",)
     url = "https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19case/fact_epirapo_covid19case.json?row=dateweek20200101-509030L&column=hcdmunicipality2020-445222L"
 
     fieldmap = {
@@ -270,26 +550,32 @@ class THLTartunnat(THLData):
 
 class THLIat(THLData):
     name = "iat"
+    datatype = DemographyData
+    valuetype = integers
     url = "https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19case/fact_epirapo_covid19case.json?column=ttr10yage-444309,sex-444328"
 
+    # a field per age group and per sex
+    def recordfields(self):
+        return self.categories("ttr10yage") + [s for s in self.categories("sex") if s != "Kaikki sukupuolet"]
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         combined = DemographyData()
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             if data.sex == "Kaikki sukupuolet":
-                setattr(combined, data.ttr10yage, int(data.value))
+                setattr(combined, data.ttr10yage, data.value)
             elif data.ttr10yage == "Kaikki ikäryhmät":
-                setattr(combined, data.sex, int(data.value))
+                setattr(combined, data.sex, data.value)
 
         combined.datadate = str(self.datadate)
 
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
 
 
 class THLIkaviikot(THLData):
     name = "ageweeks"
+    datatype = AgeWeekData
+    valuetype = integers
+    isodates = True
     url = "https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19case/fact_epirapo_covid19case.json?row=dateweek20200101-509030&row=ttr10yage-444309&column=measure-444833"
 
     fieldmap = {
@@ -300,38 +586,32 @@ class THLIkaviikot(THLData):
         "Kaikki ikäryhmät": "total",
     }
     
+    def recordfields(self):
+        return ["week"] + self.categories("ttr10yage")
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         combined = AgeWeekData()
         lastweek = None
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             if lastweek and data.week != lastweek:
-                print(combined.tojson(), file=output)
+                self.emit(combined, output)
                 combined = AgeWeekData()
             lastweek = data.week
             if data.week == 'Aika' or data.week == 'Kaikki ajat':
                 continue
-            try:
-                value = int(data.value)
-            except ValueError:
-                value = None
-            setattr(combined, data.ttr10yage, value)
+            setattr(combined, data.ttr10yage, data.value)
             combined.datadate = str(self.datadate)
-            combined.week = self.parseweek(data.week)
+            combined.week = data.week
 
         if hasattr(combined, 'total'):
-            print(combined.tojson(), file=output)
-
-    def parseweek(self, week):
-        (_, year, _, weeknum) = week.split()
-        return str(datetime.date.fromisocalendar(int(year), int(weeknum), 1))
+            self.emit(combined, output)
 
 
 class THLKuolemat(THLData):
     name = "kuolemat"
     datatype = DeathsData
+    valuetype = integers
+    derivedfields = ("cases", "deaths")
 
     url = "https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19case/fact_epirapo_covid19case.json?row=dateweek20200101-509030L&column=measure-492118"
 
@@ -344,55 +624,54 @@ class THLKuolemat(THLData):
         "Kaikki Alueet": "Koko maa",
     }
 
+    def recordfields(self):
+        return ["date", "cases", "deaths"]
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         lastdate = None
         combined = DeathsData()
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             if lastdate and data.date != lastdate:
-                print(combined.tojson(), file=output)
+                self.emit(combined, output)
                 combined = DeathsData()
             lastdate = data.date
             combined.date = data.date
             combined.datadate = str(self.datadate)
             if data.measure == "Tapausten lukumäärä":
-                combined.cases = int(data.value)
+                combined.cases = data.value
             elif data.measure == "Kuolemantapausten lukumäärä":
-                combined.deaths = int(data.value)
+                combined.deaths = data.value
 
             
 
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
 
 class THLIat2(THLData):
     name = "kuolemaiat"
+    datatype = DeathDemographyData
+    valuetype = integers
     url = "https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19case/fact_epirapo_covid19case.json?column=ttr10yage-444309,sex-444328&row=measure-492118"
 
+    # a field per age group and per sex
+    def recordfields(self):
+        return self.categories("ttr10yage") + [s for s in self.categories("sex") if s != "Kaikki sukupuolet"]
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         combined = DeathDemographyData()
-        for data in p.parse(mapper=self):
-            try:
-                datavalue = int(data.value)
-            except ValueError:
-                datavalue = None
-                
+        for data in self.parse():
             if data.sex == "Kaikki sukupuolet":
-                setattr(combined, data.ttr10yage, datavalue)
+                setattr(combined, data.ttr10yage, data.value)
             elif data.ttr10yage == "Kaikki ikäryhmät":
-                setattr(combined, data.sex, datavalue)
+                setattr(combined, data.sex, data.value)
 
         combined.datadate = str(self.datadate)
 
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
 
 class THLSairaalat(THLData):
     name = "sairaalat"
     datatype = HospitalData
+    valuetype = integers
 
     url = "https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19care/fact_epirapo_covid19care.json?row=dateweek20200101-509030L&row=erva-456367L&column=measure-547523.547516.456732.547531"
 
@@ -419,16 +698,16 @@ class THLSairaalat(THLData):
         "Käynnissä olevat vuodeosastojaksot (ennen 7.12.2020)": "vuode",
     }
 
+    def recordfields(self):
+        return ["date", "area", "basic", "special", "intensive", "normal"]
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         lastdate = None
         lastarea = None
         combined = HospitalData()
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             if lastdate and (data.date != lastdate or data.area != lastarea):
-                print(combined.tojson(), file=output)
+                self.emit(combined, output)
                 combined = HospitalData()
             lastdate = data.date
             lastarea = data.area
@@ -437,22 +716,30 @@ class THLSairaalat(THLData):
             combined.area = data.area
             #print(data.tojson())
             if data.measure == "perus":
-                combined.basic = int(data.value)
+                combined.basic = data.value
             elif data.measure == "erikois":
-                combined.special = int(data.value)
+                combined.special = data.value
             elif data.measure == "teho":
-                combined.intensive = int(data.value)
+                combined.intensive = data.value
             elif data.measure == "vuode":
-                combined.normal = int(data.value)
+                combined.normal = data.value
 
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
 
 
-datasets = {}
-for ds in list(locals().values()):
-    # print v, type(v), types.ClassType
-    if inspect.isclass(ds) and issubclass(ds, THLData) and ds.name:
-        datasets[ds.name] = ds
+datasets = {
+    ds.name: ds for ds in [
+        THLKunnat,
+        THLAlueet,
+        THLTestit,
+        THLTartunnat,
+        THLIat,
+        THLIkaviikot,
+        THLKuolemat,
+        THLIat2,
+        THLSairaalat,
+    ]
+}
 
 
 def usage():
@@ -501,27 +788,127 @@ def main():
         default=False,
         help="overwrite existing outputfile",
     )
+    p.add_option(
+        "-m",
+        "--metrics",
+        action="store_true",
+        dest="metrics",
+        default=False,
+        help="print stage metrics as json to stderr",
+    )
+    p.add_option(
+        "--metrics-file",
+        action="store",
+        dest="metricsfile",
+        default=None,
+        help="write metrics in prometheus text format to file or directory",
+    )
+    p.add_option(
+        "--profile",
+        action="store_const",
+        const="trace",
+        dest="profile",
+        default=None,
+        help="write a pstats dump and collapsed stacks next to the outputfile",
+    )
+    p.add_option(
+        "--profile-sample",
+        action="store_const",
+        const="sample",
+        dest="profile",
+        help="like --profile but sample the stack instead of tracing",
+    )
+    p.add_option(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        dest="jobs",
+        default=1,
+        help="decode large cubes in X processes",
+    )
+    p.add_option(
+        "--pipeline",
+        action="store_true",
+        dest="pipeline",
+        default=False,
+        help="encode and write the records in a separate thread",
+    )
+    p.add_option(
+        "--partitioned",
+        action="store_true",
+        dest="partitioned",
+        default=False,
+        help="write the records into a directory tree partitioned by --partition-by",
+    )
+    p.add_option(
+        "--partition-by",
+        action="store",
+        dest="partitionby",
+        default=None,
+        help="comma separated partition keys (fields, isoyear, isoweek) instead of the dataset's own",
+    )
+    p.add_option(
+        "--derived",
+        action="store_true",
+        dest="derived",
+        default=False,
+        help="add 7 day sums, incidence per 100 000 and growth to tartunnat and kuolemat",
+    )
+    p.add_option(
+        "--population",
+        action="store",
+        dest="population",
+        default=None,
+        help="kunnat, alueet or vaxpopulation output with the population for --derived",
+    )
+    p.add_option(
+        "--sqlite",
+        action="store",
+        dest="sqlite",
+        default=None,
+        help="load the records into this sqlite database instead of a file",
+    )
+    p.add_option(
+        "--since",
+        action="store",
+        dest="since",
+        default=None,
+        help="only the data from this date (YYYY-MM-DD) on",
+    )
+    p.add_option(
+        "--rebuild",
+        action="store_true",
+        dest="rebuild",
+        default=False,
+        help="parse the data even if it has not changed since the last run",
+    )
 
     (options, args) = p.parse_args()
     if not args:
         usage()
         return
+    if options.since:
+        options.since = datetime.date.fromisoformat(options.since)
     dataset = datasets.get(args[0])
     if dataset:
         ds = dataset()
         ds.setdatadate(offset=options.dateoffset)
-        if options.write_stdout:
-            ds.run(sys.stdout)
+        ds.jobs = options.jobs
+        ds.since = options.since
+        if options.derived:
+            ds.derived = ds.derivedstage(loadpopulation(options.population) if options.population else None)
+        if options.outputfile:
+            outputfile = options.outputfile
         else:
-            if options.outputfile:
-                outputfile = options.outputfile
-            else:
-                outputfile = ds.getfilename()
-            if os.path.exists(outputfile) and os.path.getsize(outputfile) > 0 and not options.overwrite:
-                print("%s exists" % outputfile)
-                return
-            with open(outputfile, 'w') as fp:
-                ds.run(fp)
+            outputfile = ds.getfilename("csv" if options.csv else "json")
+        # only plain json outputs are reused, csv and derived fields are
+        # always parsed, and so is a cube that is profiled or measured
+        rebuild = options.rebuild or options.profile or options.metrics
+        reuse = None if options.csv or options.derived else ds.reusing(outputfile, rebuild)
+        if writeoutput(options, outputfile, lambda out: profile(options.profile, outputfile, ds.process, out),
+                       ds.partitionby, reuse, ds.fields):
+            report(ds.metrics, options.metrics, options.metricsfile, sys.stderr)
     else:
         usage()
 
@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 
-import sys, os, json, csv, argparse, datetime, urllib, codecs
-import requests
+import sys, io, json, csv, argparse, datetime, urllib.parse
+
+from profiling import profile
+from sinks import Sink, writeoutput
+from fetching import download
+from checkpoint import Checkpoint
+from values import integers, decimals
+from records import fieldorder
 
 requestheaders = {'User-Agent': 'ttrdata'}
 
@@ -74,26 +80,70 @@ class UrlGen:
         return url
 
 
+# rows of a ; separated csv page; csv is only needed for quoted fields
+def readtable(text):
+    text = text.lstrip('\ufeff')
+    if '"' in text:
+        return list(csv.reader(io.StringIO(text, newline=''), delimiter=';'))
+    return [line.split(';') for line in text.splitlines() if line]
+
+
 class AgeParser:
     name = "ttrages"
 
+    years = ['2020', '2021', '2022']
+    sexes = ['all', 'men', 'women']
+    measures = ['cases', 'incidence']
+
     def __init__(self, offset = 0):
         self.datadate = datetime.date.today() - datetime.timedelta(days=offset)
-        self.data = {}
+        self.checkpoint = Checkpoint()
+
+        # every (area, time) is a dense block of sex x attribute values,
+        # None where nothing was reported, indexed through these maps
+        self.attrs = ["{}_{}".format(measure, self.agegroup_to_attr(agegroup))
+                      for measure in self.measures for agegroup in UrlGen.agegroups]
+        self.attrindex = {attr: i for (i, attr) in enumerate(self.attrs)}
+        self.sexindex = {sex: i for (i, sex) in enumerate(self.sexes)}
+        self.width = len(self.sexes) * len(self.attrs)
+        self.areas = {}
+        self.times = {}
+        self.blocks = {}
 
     def run(self, output):
-        for year in ['2020', '2021', '2022']:
+        for year in self.years:
             for agegroup in UrlGen.agegroups:
-                for sex in ['all', 'men', 'women']:
-                    for measure in ['cases', 'incidence']:
+                for sex in self.sexes:
+                    for measure in self.measures:
                         url = UrlGen.genurl(time=year, agegroup=agegroup, sex=sex, measure=measure)
-                        print(agegroup, sex, measure, url)
-                        data = requests.get(url, headers=requestheaders)
-                        data.raise_for_status()
-                        self.parse(year, agegroup, sex, measure, data)
+                        rows = self.checkpoint.get(url)
+                        if rows is None:
+                            print(agegroup, sex, measure, url, file=sys.stderr)
+                            with self.fetch(url) as body:
+                                rows = self.readrows(measure, body.text())
+                            self.checkpoint.add(url, rows)
+                        self.addrows(agegroup, sex, measure, rows)
+
+            # every input of this year's weeks has arrived
+            self.write(output, self.generate(self.times, drop=True))
+            self.times = {}
+
+        self.write(output, self.generate({'total': None}, totals=True))
+        self.checkpoint.finish()
+
+    def write(self, output, records):
+        for d in records:
+            if isinstance(output, Sink):
+                output.write(d)
+            else:
+                print(json.dumps(d, sort_keys=True, ensure_ascii=False), file=output)
+
+    # the fields of the records generate() yields (the csv columns)
+    def fields(self):
+        return fieldorder(self.name, ["area", "time", "sex", "datadate", "type"] + self.attrs)
 
-        for d in self.generate():
-            print(d, file=output)
+    def fetch(self, url):
+        return download(url, headers=requestheaders)
 
     def agegroup_to_attr(self, agegroup):
         if agegroup == '5v-ikäryhmät':
@@ -101,39 +151,55 @@ class AgeParser:
         return agegroup.replace('-', '_')
 
     def parse(self, year, agegroup, sex, measure, pagedata):
-        reader = csv.DictReader(codecs.iterdecode(pagedata.iter_lines(), 'utf-8'), delimiter=';')
-        #csvdata = [l for l in reader]
-
-        for l in reader:
-            if l['val']:
-                if measure == 'incidence':
-                    value = float(l['val'])
+        self.addrows(agegroup, sex, measure, self.readrows(measure, pagedata))
+
+    # [area, time, value] rows of one csv page, also what is checkpointed.
+    # The page is split in one go and the val column converted as a whole;
+    # rows shorter than the header (blank or trailing ones) are skipped.
+    def readrows(self, measure, pagedata):
+        table = readtable(pagedata)
+        if not table:
+            return []
+        header = table[0]
+        (areai, timei, vali) = (header.index('Alue'), header.index('time'), header.index('val'))
+        rows = [row for row in table[1:] if len(row) >= len(header)]
+        values = (decimals if measure == 'incidence' else integers)([row[vali] for row in rows], 0)
+        return [[row[areai], row[timei], value] for (row, value) in zip(rows, values)]
+
+    def addrows(self, agegroup, sex, measure, rows):
+        offset = self.sexindex[sex] * len(self.attrs) + \
+            self.attrindex["{}_{}".format(measure, self.agegroup_to_attr(agegroup))]
+        for (area, time, value) in rows:
+            block = self.blocks.get((area, time))
+            if block is None:
+                block = self.blocks[(area, time)] = [None] * self.width
+                self.areas.setdefault(area, len(self.areas))
+                self.times.setdefault(time, len(self.times))
+            block[offset] = value
+
+    # the yearly rows summed column by column, None where no year has a value
+    def total(self, area):
+        blocks = [self.blocks[(area, year)] for year in self.years if (area, year) in self.blocks]
+        if not blocks:
+            return None
+        return [sum(v for v in column if v is not None) if any(v is not None for v in column) else None
+                for column in zip(*blocks)]
+
+    def generate(self, times, drop=False, totals=False):
+        for area in self.areas:
+            for time in times:
+                if totals:
+                    block = self.total(area)
+                elif drop and time not in self.years:
+                    block = self.blocks.pop((area, time), None)
                 else:
-                    value = int(l['val'])
-            else:
-                value = 0
-            #print(l)
-
-            attrname = "{}_{}".format(measure, self.agegroup_to_attr(agegroup))
-            #print(attrname, value)
-            self.data.setdefault(l['Alue'], {}) \
-                .setdefault(l['time'], {}) \
-                .setdefault(sex, {}) \
-                [attrname] = value
-
-            if l['time'] in ['2020', '2021', '2022']:
-                total = self.data.get(l['Alue'], {}).get('total', {}).get(sex, {}).get(attrname, 0)
-                
-                self.data.setdefault(l['Alue'], {}) \
-                    .setdefault('total', {}) \
-                    .setdefault(sex, {}) \
-                    [attrname] = value + total
-
-
-    def generate(self):
-        for area in self.data:
-            for time in self.data[area]:
-                for sex in self.data[area][time]:
+                    block = self.blocks.get((area, time))
+                if block is None:
+                    continue
+                for (sexi, sex) in enumerate(self.sexes):
+                    values = block[sexi * len(self.attrs):(sexi + 1) * len(self.attrs)]
+                    if all(v is None for v in values):
+                        continue
                     #agesum = sum(self.data[area][time][sex].values())
                     d = dict(
                         type = 'ttrages',
@@ -142,12 +208,12 @@ class AgeParser:
                         sex = sex,
                         datadate = str(self.datadate),
                     )
-                    d.update(self.data[area][time][sex])
-                    yield json.dumps(d, sort_keys=True, ensure_ascii=False)
+                    d.update((attr, v) for (attr, v) in zip(self.attrs, values) if v is not None)
+                    yield d
 
-    def getfilename(self):
+    def getfilename(self, extension="json"):
         datestr = self.datadate.strftime("%Y%m%d")
-        return "%s-%s.json" % (self.name, datestr)
+        return "%s-%s.%s" % (self.name, datestr, extension)
 
 
 datasets = {
@@ -199,6 +265,35 @@ def parse_args():
         default=0,
         help="Offset date by X days",
     )
+    p.add_argument(
+        "--profile",
+        action="store_const",
+        const="trace",
+        dest="profile",
+        default=None,
+        help="write a pstats dump and collapsed stacks next to the outputfile",
+    )
+    p.add_argument(
+        "--profile-sample",
+        action="store_const",
+        const="sample",
+        dest="profile",
+        help="like --profile but sample the stack instead of tracing",
+    )
+    p.add_argument(
+        "--sqlite",
+        action="store",
+        dest="sqlite",
+        default=None,
+        help="load the records into this sqlite database instead of a file",
+    )
+    p.add_argument(
+        "--restart",
+        action="store_true",
+        dest="restart",
+        default=False,
+        help="discard the checkpoint of an earlier failed run",
+    )
     p.add_argument("cmd", choices=datasets.keys())
 
     return p.parse_args()
@@ -214,18 +309,12 @@ def main():
     dataset = datasets.get(args.cmd)
     if dataset:
         ds = dataset(offset=args.dateoffset)
-        if args.write_stdout:
-            ds.run(sys.stdout)
+        if args.outputfile:
+            outputfile = args.outputfile
         else:
-            if args.outputfile:
-                outputfile = args.outputfile
-            else:
-                outputfile = ds.getfilename()
-            if os.path.exists(outputfile) and os.path.getsize(outputfile) > 0 and not args.overwrite:
-                print("%s exists" % outputfile)
-                return
-            with open(outputfile, 'w') as fp:
-                ds.run(fp)
+            outputfile = ds.getfilename("csv" if args.csv else "json")
+        ds.checkpoint = Checkpoint(outputfile + ".checkpoint", [ds.name, str(ds.datadate)], args.restart)
+        writeoutput(args, outputfile, lambda out: profile(args.profile, outputfile, ds.run, out), fields=ds.fields)
     else:
         usage()
 
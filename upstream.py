@@ -0,0 +1,105 @@
+import os, json, hashlib
+
+manifestname = '.upstream.json'
+
+# part of every recorded hash: bump it when a change to the parsers
+# changes their output, so that no output of the older code is reused
+version = 1
+
+
+class Unchanged(Exception):
+    pass
+
+
+# What each dataset output was last built from, kept in .upstream.json
+# next to the outputs: the content hash (with version) and validators
+# (ETag, Last-Modified) of every url, and per dataset the url, output file
+# and datadate. A url is only checked if every dataset read from it has
+# its previous output at hand to reuse, written by this version.
+class Upstream:
+
+    def __init__(self, directory='.', rebuild=False):
+        self.path = os.path.join(directory or '.', manifestname)
+        self.rebuild = rebuild
+        self.state = {"urls": {}, "datasets": {}}
+        if os.path.exists(self.path):
+            with open(self.path) as fp:
+                self.state = json.load(fp)
+        self.allowed = set()
+        self.seen = {}
+
+    def save(self):
+        tmpfile = self.path + ".tmp"
+        with open(tmpfile, 'w') as fp:
+            json.dump(self.state, fp, indent=1, sort_keys=True)
+        os.replace(tmpfile, self.path)
+
+    def previous(self, name):
+        return self.state["datasets"].get(name)
+
+    # names are the datasets that will be built from url, an output cut
+    # at a date (--since) is only reused for the same cut
+    def allow(self, url, names, since=None):
+        if self.rebuild or url not in self.state["urls"]:
+            return
+        if self.state["urls"][url].get("version") != version:
+            return
+        for name in names:
+            entry = self.previous(name)
+            if not entry or entry["url"] != url or not os.path.exists(entry["outputfile"]):
+                return
+            if entry.get("since") != (since and str(since)):
+                return
+        self.allowed.add(url)
+
+    def validators(self, url):
+        headers = {}
+        if url in self.allowed:
+            entry = self.state["urls"][url]
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("lastmodified"):
+                headers["If-Modified-Since"] = entry["lastmodified"]
+        return headers
+
+    def unchanged(self, url, body):
+        if body.status == 304:
+            return url in self.allowed
+        digest = hashlib.sha1(b"%d\n" % version)
+        with body.view() as view:
+            digest.update(view)
+        digest = digest.hexdigest()
+        self.seen[url] = dict(
+            hash=digest,
+            version=version,
+            etag=body.headers.get("ETag"),
+            lastmodified=body.headers.get("Last-Modified"),
+        )
+        return url in self.allowed and self.state["urls"][url]["hash"] == digest
+
+    def record(self, name, url, outputfile, datadate, since=None):
+        if url in self.seen:
+            self.state["urls"][url] = self.seen[url]
+        self.state["datasets"][name] = dict(url=url, outputfile=outputfile, datadate=str(datadate))
+        if since:
+            self.state["datasets"][name]["since"] = str(since)
+        self.save()
+
+    # writes outputfile from the previous output of name with datadate
+    # patched, without decoding it
+    def reuse(self, name, outputfile, datadate):
+        entry = self.previous(name)
+        if os.path.abspath(entry["outputfile"]) != os.path.abspath(outputfile):
+            old = ('"datadate": "%s"' % entry["datadate"]).encode('utf-8')
+            new = ('"datadate": "%s"' % datadate).encode('utf-8')
+            tmpfile = outputfile + ".tmp"
+            if old == new:
+                if os.path.exists(tmpfile):
+                    os.unlink(tmpfile)
+                os.link(entry["outputfile"], tmpfile)
+            else:
+                with open(entry["outputfile"], 'rb') as src, open(tmpfile, 'wb') as dst:
+                    dst.write(src.read().replace(old, new))
+            os.replace(tmpfile, outputfile)
+        self.state["datasets"][name] = dict(entry, outputfile=outputfile, datadate=str(datadate))
+        self.save()
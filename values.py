@@ -0,0 +1,62 @@
+# Conversion of whole value columns. The sampo cubes mark suppressed
+# values with '..' and write decimals with a comma; every converter turns
+# a missing value into default (None unless given).
+
+missing = frozenset(['..', ''])
+
+
+def ismissing(value):
+    return value is None or (isinstance(value, str) and value.strip() in missing)
+
+
+def cleaninteger(value):
+    if isinstance(value, str):
+        # thousands separated by spaces
+        return int(value.replace(' ', '').replace('\xa0', ''))
+    return int(value)
+
+
+def integers(column, default=None):
+    try:
+        return list(map(int, column))
+    except (ValueError, TypeError):
+        return [default if ismissing(v) else cleaninteger(v) for v in column]
+
+
+def decimals(column, default=None):
+    try:
+        return list(map(float, column))
+    except (ValueError, TypeError):
+        return [default if ismissing(v) else float(str(v).replace(',', '.').replace(' ', '')) for v in column]
+
+
+# decimals kept as text with a decimal point, as the coverage fields are
+# published; a column of texts without missing values gets its commas
+# replaced in one go
+def decimaltexts(column, default=None):
+    column = list(column)
+    try:
+        texts = "\0".join(column)
+    except TypeError:
+        texts = None
+    if column and texts is not None and missing.isdisjoint(map(str.strip, column)):
+        return texts.replace(',', '.').split('\0')
+    return [default if ismissing(v) else str(v).replace(',', '.') for v in column]
+
+
+# worldometers numbers use a comma as thousands separator, cells that are
+# not numbers (names, 'N/A') are returned as they are
+def counts(column):
+    result = []
+    for v in column:
+        try:
+            result.append(int(v.replace(',', '')))
+        except (ValueError, AttributeError):
+            result.append(v)
+    return result
+
+
+def convert(column, valuetype, default=None):
+    if valuetype is None:
+        return list(column)
+    return valuetype(column, default)
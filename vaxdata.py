@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 
-import sys, os, json, inspect, argparse, datetime
-import requests
+import sys, os, json, argparse, datetime
 
-from thldata import Parser, THLData, ParserData
-
-requestheaders = {'User-Agent': 'thldata'}
+from thldata import THLData, ParserData
+from values import integers, decimaltexts
+from metrics import report
+from profiling import profile
+from sinks import writeoutput
+from planning import plan
+from upstream import Upstream, Unchanged
+from derived import loadpopulation
 
     
 class VaxWeekData(ParserData):
@@ -32,8 +36,18 @@ class VaxDayData(ParserData):
 class VaxAreaDayData(ParserData):
     type = "vaxareadays"
 
+# the age fields of the datasets with two age dimensions: age2 unless it
+# is the total, then age
+def agefields(ds):
+    return ds.categories("age") + [age for age in ds.categories("age2") if age != "Yhteensä"]
+
+
 class VaxWeeks(THLData):
     name = "vaxweeks"
+    datatype = VaxWeekData
+    valuetype = integers
+    isodates = True
+    partitionby = ("isoyear", "isoweek")
     
     url = "https://sampo.thl.fi/pivot/prod/fi/vaccreg/cov19cov/fact_cov19cov.json?row=area-518362&column=dateweek20201226-525425&column=cov_vac_dose-533174.533170.533164.639082.701924.&column=measure-533175&column=cov_vac_age-518413L&column=cov_vac_age-660962L"
 
@@ -56,16 +70,16 @@ class VaxWeeks(THLData):
         "Kaikki annokset": "all",
     }
 
+    def recordfields(self):
+        return ["week", "area", "dose"] + ["doses-" + age for age in agefields(self)]
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         lastweekareadose = None
         combined = VaxWeekData()
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             #print(data.tojson())
             if lastweekareadose and (data.week, data.area, data.dose) != lastweekareadose:
-                print(combined.tojson(), file=output)
+                self.emit(combined, output)
                 combined = VaxWeekData()
 
             lastweekareadose = (data.week, data.area, data.dose)
@@ -77,16 +91,16 @@ class VaxWeeks(THLData):
                 agefield = data.age
             else:
                 agefield = data.age2
-            if data.value == '..':
-                setattr(combined, "doses-"+agefield, None)
-            else:
-                setattr(combined, "doses-"+agefield, int(data.value))
+            setattr(combined, "doses-"+agefield, data.value)
             
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
 
         
 class VaxCoverage(THLData):
     name = "vaxcoverage"
+    datatype = VaxCovData
+    valuetype = integers
+    measuretypes = {"Rokotuskattavuus": decimaltexts}
     
     url = "https://sampo.thl.fi/pivot/prod/fi/vaccreg/cov19cov/fact_cov19cov.json?row=area-518362&column=cov_vac_dose-533170.533164.639082.701924.&column=measure-533175.533172.533185.433796.&column=cov_vac_age-518413L&column=cov_vac_age-660962L"
     
@@ -110,15 +124,16 @@ class VaxCoverage(THLData):
         "Kaikki annokset": "all",
     }
 
+    def recordfields(self):
+        return ["area", "dose"] + ["%s-%s" % (measure, age) for measure in ("persons", "doses", "coverage", "population")
+                                   for age in agefields(self)]
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         lastareadose = None
         combined = VaxCovData()
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             if lastareadose and (data.area, data.dose) != lastareadose:
-                print(combined.tojson(), file=output)
+                self.emit(combined, output)
                 combined = VaxCovData()
 
             lastareadose = (data.area, data.dose)
@@ -130,21 +145,23 @@ class VaxCoverage(THLData):
             else:
                 agefield = data.age2
             if data.measure == "Rokotettuja henkilöitä":
-                setattr(combined, "persons-"+agefield, int(data.value))
+                setattr(combined, "persons-"+agefield, data.value)
             elif data.measure == "Annettuja annoksia":
-                setattr(combined, "doses-"+agefield, int(data.value))
+                setattr(combined, "doses-"+agefield, data.value)
             elif data.measure == "Rokotuskattavuus":
-                setattr(combined, "coverage-"+agefield, data.value.replace(',', '.'))
+                setattr(combined, "coverage-"+agefield, data.value)
             elif data.measure == "Asukkaita":
-                setattr(combined, "population-"+agefield, int(data.value))
+                setattr(combined, "population-"+agefield, data.value)
             else:
                 raise Exception("Unknown measure %s" % data.measure)
             
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
 
 
 class VaxPopulation(THLData):
     name = "vaxpopulation"
+    datatype = VaxPopData
+    valuetype = integers
     
     url = "https://sampo.thl.fi/pivot/prod/fi/vaccreg/cov19cov/fact_cov19cov.json?row=area-518362&column=measure-433796&column=cov_vac_age-518413L&column=cov_vac_age-660962L"
 
@@ -167,32 +184,34 @@ class VaxPopulation(THLData):
         "Kaikki annokset": "all",
     }
 
+    def recordfields(self):
+        return ["area"] + agefields(self)
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         lastarea = None
         combined = VaxPopData()
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             #print(data.tojson())
             if lastarea and data.area != lastarea:
-                print(combined.tojson(), file=output)
+                self.emit(combined, output)
                 combined = VaxPopData()
 
             lastarea = data.area
             combined.area = data.area
             combined.datadate = str(self.datadate)
             if data.age2 == 'Yhteensä':
-                setattr(combined, data.age, int(data.value))
+                setattr(combined, data.age, data.value)
             else:
-                setattr(combined, data.age2, int(data.value))
+                setattr(combined, data.age2, data.value)
                 
             
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
 
         
 class VaxProduct(THLData):
     name = "vaxproduct"
+    datatype = VaxProdData
+    valuetype = integers
 
     url = "https://sampo.thl.fi/pivot/prod/fi/vaccreg/cov19cov/fact_cov19cov.json?row=area-518362&column=dateweek20201226-525425&column=vacprod-533729.533761.547315.533741.&column=measure-533175&column=cov_vac_dose-533174L&column=cov_vac_age-518413."
 
@@ -221,15 +240,15 @@ class VaxProduct(THLData):
         "COVID-19 Vaccine Janssen (JANSSEN-CILAG)": "Janssen",
     }
 
+    def recordfields(self):
+        return ["week", "area", "product", "dose"] + self.categories("age")
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         lastdata = None
         combined = VaxProdData()
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             if lastdata and (data.week, data.area, data.product, data.dose) != lastdata:
-                print(combined.tojson(), file=output)
+                self.emit(combined, output)
                 combined = VaxProdData()
 
             lastdata = (data.week, data.area, data.product, data.dose)
@@ -238,13 +257,15 @@ class VaxProduct(THLData):
             combined.product = data.product
             combined.dose = data.dose
             combined.datadate = str(self.datadate)
-            setattr(combined, data.age, int(data.value))
+            setattr(combined, data.age, data.value)
             
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
 
 
 class VaxProductAreas(THLData):
     name = "vaxproductareas"
+    datatype = VaxProdAreaData
+    valuetype = integers
 
     url = "https://sampo.thl.fi/pivot/prod/fi/vaccreg/cov19cov/fact_cov19cov.json?row=area-518376L&column=vacprod-533729.533761.547315.533741.&column=cov_vac_dose-533174L&column=measure-533175&column=cov_vac_age-518413."
 
@@ -271,15 +292,15 @@ class VaxProductAreas(THLData):
         "Kaikki annokset": "all",
     }
 
+    def recordfields(self):
+        return ["area", "product", "dose"] + self.categories("age")
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         lastdoseareaprod = None
         combined = VaxProdAreaData()
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             if lastdoseareaprod and (data.dose, data.area, data.product) != lastdoseareaprod:
-                print(combined.tojson(), file=output)
+                self.emit(combined, output)
                 combined = VaxProdAreaData()
 
             lastdoseareaprod = (data.dose, data.area, data.product)
@@ -287,13 +308,17 @@ class VaxProductAreas(THLData):
             combined.product = data.product
             combined.dose = data.dose
             combined.datadate = str(self.datadate)
-            setattr(combined, data.age, int(data.value))
+            setattr(combined, data.age, data.value)
             
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
 
 
 class VaxMunicipalities(THLData):
     name = "vaxmunicipalities"
+    datatype = VaxMunicipalityData
+    valuetype = integers
+    measuretypes = {"Rokotuskattavuus": decimaltexts}
+    partitionby = ("area",)
 
     url = "https://sampo.thl.fi/pivot/prod/fi/vaccreg/cov19cov/fact_cov19cov.json?row=area-518376L&column=cov_vac_dose-533174.533170.533164.639082.701924.&column=measure-533175.533172.533185.433796.&column=cov_vac_age-518413L&column=cov_vac_age-660962L"
 
@@ -316,15 +341,16 @@ class VaxMunicipalities(THLData):
         "Kaikki annokset": "all",
     }
 
+    def recordfields(self):
+        return ["area", "dose"] + ["%s-%s" % (measure, age) for measure in ("persons", "doses", "coverage", "population")
+                                   for age in agefields(self)]
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         lastareadose = None
         combined = VaxMunicipalityData()
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             if lastareadose and (data.area, data.dose) != lastareadose:
-                print(combined.tojson(), file=output)
+                self.emit(combined, output)
                 combined = VaxMunicipalityData()
 
             lastareadose = (data.area, data.dose)
@@ -336,21 +362,25 @@ class VaxMunicipalities(THLData):
             else:
                 agefield = data.age2
             if data.measure == "Rokotettuja henkilöitä":
-                setattr(combined, "persons-"+agefield, int(data.value))
+                setattr(combined, "persons-"+agefield, data.value)
             elif data.measure == "Rokotuskattavuus":
-                setattr(combined, "coverage-"+agefield, data.value.replace(',', '.'))
+                setattr(combined, "coverage-"+agefield, data.value)
             elif data.measure == "Annettuja annoksia":
-                setattr(combined, "doses-"+agefield, int(data.value))
+                setattr(combined, "doses-"+agefield, data.value)
             elif data.measure == "Asukkaita":
-                setattr(combined, "population-"+agefield, int(data.value))
+                setattr(combined, "population-"+agefield, data.value)
             else:
                 print(data.tojson())
                 raise Exception("Unknown measure %s" % data.measure)
            
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
 
 class VaxDays(THLData):
     name = "vaxdays"
+    datatype = VaxDayData
+    valuetype = integers
+    isodates = True
+    derivedfields = ("first", "second", "third", "fourth")
 
     url = "https://sampo.thl.fi/pivot/prod/fi/vaccreg/cov19cov/fact_cov19cov.json?row=dateweek20201226-525459L&filter=measure-533175&column=vacprod-533726&column=cov_vac_dose-533170L"
 
@@ -373,15 +403,15 @@ class VaxDays(THLData):
         "Kaikki tuotteet": "all",
     }
 
+    def recordfields(self):
+        return ["date", "product", "first", "second", "third", "fourth"]
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         lastdata = None
         combined = VaxDayData()
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             if lastdata and (data.date, data.product) != lastdata:
-                print(combined.tojson(), file=output)
+                self.emit(combined, output)
                 combined = VaxDayData()
 
             lastdata = (data.date, data.product)
@@ -389,21 +419,24 @@ class VaxDays(THLData):
             combined.product = data.product
             combined.datadate = str(self.datadate)
             if data.dose == "first":
-                combined.first = int(data.value)
+                combined.first = data.value
             elif data.dose == "second":
-                combined.second = int(data.value)
+                combined.second = data.value
             elif data.dose == "third":
-                combined.third = int(data.value)
+                combined.third = data.value
             elif data.dose == "fourth":
-                combined.fourth = int(data.value)
+                combined.fourth = data.value
             else:
                 print(data.tojson())
                 raise Exception("Unknown dose %s" % data.dose)
 
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
 
 class VaxAreaDays(THLData):
     name = "vaxareadays"
+    datatype = VaxAreaDayData
+    valuetype = integers
+    isodates = True
 
     url = "https://sampo.thl.fi/pivot/prod/fi/vaccreg/cov19cov/fact_cov19cov.json?row=dateweek20201226-525459L&filter=measure-533175&column=area-518362&column=cov_vac_dose-533170L"
 
@@ -421,15 +454,15 @@ class VaxAreaDays(THLData):
         "Kaikki tuotteet": "all",
     }
 
+    def recordfields(self):
+        return ["date", "area", "first", "second", "third"]
+
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         lastdata = None
         combined = VaxAreaDayData()
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             if lastdata and (data.date, data.area) != lastdata:
-                print(combined.tojson(), file=output)
+                self.emit(combined, output)
                 combined = VaxAreaDayData()
 
             lastdata = (data.date, data.area)
@@ -437,24 +470,37 @@ class VaxAreaDays(THLData):
             combined.area = data.area
             combined.datadate = str(self.datadate)
             if data.dose == "first":
-                combined.first = int(data.value)
+                combined.first = data.value
             elif data.dose == "second":
-                combined.second = int(data.value)
+                combined.second = data.value
             elif data.dose == "third":
-                combined.third = int(data.value)
+                combined.third = data.value
             else:
                 print(data.tojson())
                 raise Exception("Unknown dose %s" % data.dose)
 
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
+
 
 
+# the category of a dimension that stands for all of it, used to cut a
+# dataset that does not select the dimension out of a request that does
+cubetotals = {
+    "cov_vac_dose": "533174",
+}
 
-datasets = {}
-for dsc in list(locals().values()):
-    # print v, type(v), types.ClassType
-    if inspect.isclass(dsc) and issubclass(dsc, THLData) and dsc.name:
-        datasets[dsc.name] = dsc
+datasets = {
+    dsc.name: dsc for dsc in [
+        VaxWeeks,
+        VaxCoverage,
+        VaxPopulation,
+        VaxProduct,
+        VaxProductAreas,
+        VaxMunicipalities,
+        VaxDays,
+        VaxAreaDays,
+    ]
+}
 
 
 def usage():
@@ -502,32 +548,166 @@ def parse_args():
         default=False,
         help="overwrite existing outputfile",
     )
-    p.add_argument("cmd", choices=datasets.keys())
+    p.add_argument(
+        "-m",
+        "--metrics",
+        action="store_true",
+        dest="metrics",
+        default=False,
+        help="print stage metrics as json to stderr",
+    )
+    p.add_argument(
+        "--metrics-file",
+        action="store",
+        dest="metricsfile",
+        default=None,
+        help="write metrics in prometheus text format to file or directory",
+    )
+    p.add_argument(
+        "--profile",
+        action="store_const",
+        const="trace",
+        dest="profile",
+        default=None,
+        help="write a pstats dump and collapsed stacks next to the outputfile",
+    )
+    p.add_argument(
+        "--profile-sample",
+        action="store_const",
+        const="sample",
+        dest="profile",
+        help="like --profile but sample the stack instead of tracing",
+    )
+    p.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        dest="jobs",
+        default=1,
+        help="decode large cubes in X processes",
+    )
+    p.add_argument(
+        "--pipeline",
+        action="store_true",
+        dest="pipeline",
+        default=False,
+        help="encode and write the records in a separate thread",
+    )
+    p.add_argument(
+        "--partitioned",
+        action="store_true",
+        dest="partitioned",
+        default=False,
+        help="write the records into a directory tree partitioned by --partition-by",
+    )
+    p.add_argument(
+        "--partition-by",
+        action="store",
+        dest="partitionby",
+        default=None,
+        help="comma separated partition keys (fields, isoyear, isoweek) instead of the dataset's own",
+    )
+    p.add_argument(
+        "--derived",
+        action="store_true",
+        dest="derived",
+        default=False,
+        help="add 7 day sums, incidence per 100 000 and growth to vaxdays",
+    )
+    p.add_argument(
+        "--population",
+        action="store",
+        dest="population",
+        default=None,
+        help="vaxpopulation or kunnat output with the population for --derived",
+    )
+    p.add_argument(
+        "--sqlite",
+        action="store",
+        dest="sqlite",
+        default=None,
+        help="load the records into this sqlite database instead of a file",
+    )
+    p.add_argument(
+        "--since",
+        action="store",
+        type=datetime.date.fromisoformat,
+        dest="since",
+        default=None,
+        help="only the data from this date (YYYY-MM-DD) on",
+    )
+    p.add_argument(
+        "--rebuild",
+        action="store_true",
+        dest="rebuild",
+        default=False,
+        help="parse the data even if it has not changed since the last run",
+    )
+    p.add_argument("cmd", nargs="+", choices=datasets.keys())
 
     return p.parse_args()
 
 
+def rundataset(ds, outputfile, args):
+    if writeoutput(args, outputfile, lambda out: profile(args.profile, outputfile, ds.process, out), ds.partitionby,
+                   fields=ds.fields):
+        report(ds.metrics, args.metrics, args.metricsfile, sys.stderr)
+
+
 def main():
     args = parse_args()
     if not args:
         usage()
         return
-    dataset = datasets.get(args.cmd)
-    if dataset:
-        ds = dataset()
+    if args.outputfile and len(args.cmd) > 1:
+        print("-f/--outputfile takes one dataset")
+        return
+
+    population = loadpopulation(args.population) if args.population else None
+    outputfiles = {}
+    for name in args.cmd:
+        ds = datasets[name]()
         ds.setdatadate(offset=args.dateoffset)
-        if args.write_stdout:
-            ds.run(sys.stdout)
-        else:
-            if args.outputfile:
-                outputfile = args.outputfile
-            else:
-                outputfile = ds.getfilename()
+        ds.jobs = args.jobs
+        ds.since = args.since
+        if args.derived:
+            ds.derived = ds.derivedstage(population)
+        outputfile = args.outputfile or ds.getfilename("csv" if args.csv else "json")
+        if args.partitioned:
+            if os.path.exists(os.path.splitext(outputfile)[0]) and not args.overwrite:
+                print("%s exists" % os.path.splitext(outputfile)[0])
+                continue
+        elif not (args.sqlite or args.write_stdout):
             if os.path.exists(outputfile) and os.path.getsize(outputfile) > 0 and not args.overwrite:
                 print("%s exists" % outputfile)
-                return
-            with open(outputfile, 'w') as fp:
-                ds.run(fp)
+                continue
+        outputfiles[ds] = outputfile
+
+    # only plain json files are reused, csv, partitioned and derived outputs
+    # are always parsed
+    upstream = None
+    if not (args.sqlite or args.write_stdout or args.csv or args.partitioned or args.derived):
+        # a cube that is profiled or measured is always parsed
+        upstream = Upstream(os.path.dirname(args.outputfile or ""), args.rebuild or args.profile or args.metrics)
+
+    # datasets cut from the same cube share one request
+    for group in plan(list(outputfiles), cubetotals):
+        members = [ds for (ds, query) in group.members]
+        if upstream is not None:
+            url = group.query.url() if len(members) > 1 else members[0].url
+            upstream.allow(url, [ds.name for ds in members], args.since)
+            for ds in members:
+                ds.upstream = upstream
+        try:
+            for ds in group.datasets():
+                rundataset(ds, outputfiles[ds], args)
+                if upstream is not None:
+                    upstream.record(ds.name, url, outputfiles[ds], ds.datadate, args.since)
+        except Unchanged:
+            for ds in members:
+                print("%s: unchanged since %s" % (ds.name, upstream.previous(ds.name)["datadate"]))
+                upstream.reuse(ds.name, outputfiles[ds], ds.datadate)
 
 
 if __name__ == "__main__":
@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 
-import sys, os, json, inspect, argparse, datetime
-import requests
+import sys, json, argparse, datetime
 
-from thldata import Parser, THLData, ParserData
-
-requestheaders = {'User-Agent': 'thldata'}
+from thldata import THLData, ParserData
+from values import integers, decimals
+from metrics import report
+from profiling import profile
+from sinks import writeoutput
 
 
 class VaxStatData(ParserData):
@@ -15,9 +16,6 @@ class VaxStatData(ParserData):
         if datatype:
             self.type = datatype
 
-def tofloat(self, v):
-    return float(v.replace(',', '.'))
-
 class VaxStatBase(THLData):
 
     valuemap = {
@@ -41,51 +39,33 @@ class VaxStatBase(THLData):
     }
 
     groupfields = ("month",)
-    valuetype = int
-
-    months = [
-        'tammikuu',
-        'helmikuu',
-        'maaliskuu',
-        'huhtikuu',
-        'toukokuu',
-        'kesäkuu',
-        'heinäkuu',
-        'elokuu',
-        'syyskuu',
-        'lokakuu',
-        'marraskuu',
-        'joulukuu',
-    ]
+    valuetype = integers
+    isodates = True
 
+    def recordfields(self):
+        return ["month"] + ["%s-%s" % (status, age) for status in self.categories("vaxstatus")
+                            for age in self.categories("agegroup")]
 
     def getgroupvalue(self, data):
         return [getattr(data, attr) for attr in self.groupfields]
 
-    def getmonth(self, monthyear):
-        (month, year) = monthyear.split()
-        return f"{year}-{self.months.index(month)+1:02d}"
-
     def run(self, output):
-        data = requests.get(self.url, headers=requestheaders)
-        data.raise_for_status()
-        p = Parser(data=data.json())
         combined = VaxStatData(datatype=self.datatype)
         lastvalue = None
-        for data in p.parse(mapper=self):
+        for data in self.parse():
             #print(data.tojson())
             groupvalue = self.getgroupvalue(data)
             if lastvalue and groupvalue != lastvalue:
-                print(combined.tojson(), file=output)
+                self.emit(combined, output)
                 combined = VaxStatData(datatype=self.datatype)
 
             lastvalue = groupvalue
-            combined.month = self.getmonth(data.month)
+            combined.month = data.month
                 
             combined.datadate = str(self.datadate)
-            setattr(combined, f"{data.vaxstatus}-{data.agegroup}", self.valuetype(data.value))
+            setattr(combined, f"{data.vaxstatus}-{data.agegroup}", data.value)
             
-        print(combined.tojson(), file=output)
+        self.emit(combined, output)
 
     
 class VaxStatPatients(VaxStatBase):
@@ -118,7 +98,7 @@ class VaxStatPersonMonths(VaxStatBase):
 
     url = "https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19inci/fact_epirapo_covid19inci.json?row=quadrimestermonth-642743L&column=inciagegroup-639348&row=incivacstatus-639350&filter=measure-650912"
     datatype = "vaxstatpersonmonths"
-    valuetype = tofloat
+    valuetype = decimals
     
 
 class VaxIncPatients(VaxStatBase):
@@ -127,7 +107,7 @@ class VaxIncPatients(VaxStatBase):
     url = "https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19inci/fact_epirapo_covid19inci.json?row=quadrimestermonth-642743L&column=inciagegroup-639348&row=incivacstatus-639350&filter=measure-642065"
 
     datatype = "vaxincpatients"
-    valuetype = tofloat
+    valuetype = decimals
     
 
 class VaxIncICU(VaxStatBase):
@@ -135,7 +115,7 @@ class VaxIncICU(VaxStatBase):
 
     url = "https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19inci/fact_epirapo_covid19inci.json?row=quadrimestermonth-642743L&column=inciagegroup-639348&row=incivacstatus-639350&filter=measure-642062"
     datatype = "vaxincicu"
-    valuetype = tofloat
+    valuetype = decimals
 
     
 class VaxIncDeaths(VaxStatBase):
@@ -143,7 +123,7 @@ class VaxIncDeaths(VaxStatBase):
 
     url = "https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19inci/fact_epirapo_covid19inci.json?row=quadrimestermonth-642743L&column=inciagegroup-639348&row=incivacstatus-639350&filter=measure-642064"
     datatype = "vaxincdeaths"
-    valuetype = tofloat
+    valuetype = decimals
 
     
 class VaxIncCases(VaxStatBase):
@@ -151,15 +131,23 @@ class VaxIncCases(VaxStatBase):
 
     url = "https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19inci/fact_epirapo_covid19inci.json?row=quadrimestermonth-642743L&column=inciagegroup-639348&row=incivacstatus-639350&filter=measure-642063"
     datatype = "vaxinccases"
-    valuetype = tofloat
+    valuetype = decimals
 
     
     
-datasets = {}
-for dsc in list(locals().values()):
-    # print v, type(v), types.ClassType
-    if inspect.isclass(dsc) and issubclass(dsc, THLData) and dsc.name:
-        datasets[dsc.name] = dsc
+datasets = {
+    dsc.name: dsc for dsc in [
+        VaxStatPatients,
+        VaxStatICU,
+        VaxStatDeaths,
+        VaxStatCases,
+        VaxStatPersonMonths,
+        VaxIncPatients,
+        VaxIncICU,
+        VaxIncDeaths,
+        VaxIncCases,
+    ]
+}
 
 
 def usage():
@@ -207,6 +195,88 @@ def parse_args():
         default=False,
         help="overwrite existing outputfile",
     )
+    p.add_argument(
+        "-m",
+        "--metrics",
+        action="store_true",
+        dest="metrics",
+        default=False,
+        help="print stage metrics as json to stderr",
+    )
+    p.add_argument(
+        "--metrics-file",
+        action="store",
+        dest="metricsfile",
+        default=None,
+        help="write metrics in prometheus text format to file or directory",
+    )
+    p.add_argument(
+        "--profile",
+        action="store_const",
+        const="trace",
+        dest="profile",
+        default=None,
+        help="write a pstats dump and collapsed stacks next to the outputfile",
+    )
+    p.add_argument(
+        "--profile-sample",
+        action="store_const",
+        const="sample",
+        dest="profile",
+        help="like --profile but sample the stack instead of tracing",
+    )
+    p.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        dest="jobs",
+        default=1,
+        help="decode large cubes in X processes",
+    )
+    p.add_argument(
+        "--pipeline",
+        action="store_true",
+        dest="pipeline",
+        default=False,
+        help="encode and write the records in a separate thread",
+    )
+    p.add_argument(
+        "--partitioned",
+        action="store_true",
+        dest="partitioned",
+        default=False,
+        help="write the records into a directory tree partitioned by --partition-by",
+    )
+    p.add_argument(
+        "--partition-by",
+        action="store",
+        dest="partitionby",
+        default=None,
+        help="comma separated partition keys (fields, isoyear, isoweek) instead of the dataset's own",
+    )
+    p.add_argument(
+        "--sqlite",
+        action="store",
+        dest="sqlite",
+        default=None,
+        help="load the records into this sqlite database instead of a file",
+    )
+    p.add_argument(
+        "--since",
+        action="store",
+        type=datetime.date.fromisoformat,
+        dest="since",
+        default=None,
+        help="only the data from this date (YYYY-MM-DD) on",
+    )
+    p.add_argument(
+        "--rebuild",
+        action="store_true",
+        dest="rebuild",
+        default=False,
+        help="parse the data even if it has not changed since the last run",
+    )
     p.add_argument("cmd", choices=datasets.keys())
 
     return p.parse_args()
@@ -221,18 +291,19 @@ def main():
     if dataset:
         ds = dataset()
         ds.setdatadate(offset=args.dateoffset)
-        if args.write_stdout:
-            ds.run(sys.stdout)
+        ds.jobs = args.jobs
+        ds.since = args.since
+        if args.outputfile:
+            outputfile = args.outputfile
         else:
-            if args.outputfile:
-                outputfile = args.outputfile
-            else:
-                outputfile = ds.getfilename()
-            if os.path.exists(outputfile) and os.path.getsize(outputfile) > 0 and not args.overwrite:
-                print("%s exists" % outputfile)
-                return
-            with open(outputfile, 'w') as fp:
-                ds.run(fp)
+            outputfile = ds.getfilename("csv" if args.csv else "json")
+        # only json outputs are reused, csv is always parsed, and so is a
+        # cube that is profiled or measured
+        rebuild = args.rebuild or args.profile or args.metrics
+        reuse = None if args.csv else ds.reusing(outputfile, rebuild)
+        if writeoutput(args, outputfile, lambda out: profile(args.profile, outputfile, ds.process, out),
+                       ds.partitionby, reuse, ds.fields):
+            report(ds.metrics, args.metrics, args.metricsfile, sys.stderr)
 
 
 if __name__ == "__main__":
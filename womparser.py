@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os, json, datetime, re, urllib, time, argparse
+import sys, os, json, datetime, re, urllib.parse, time, argparse, collections
 
-import requests
-
-from lxml import html
+from profiling import profile
+from sinks import writerecord, writeoutput
+from fetching import download
+from checkpoint import Checkpoint
+from values import counts
+from derived import Derived, loadpopulation, loadhistory
+from records import fieldorder
 
 
 class ParserData():
@@ -21,40 +25,66 @@ class ParserData():
             self.__values[attr] = value
         super().__setattr__(attr, value)
     
+    def values(self):
+        return self.__values
+
     def tojson(self):
         return json.dumps(self.__values, sort_keys=True)
 
     def __str__(self):
         return str(self.__values)
 
+# fields are the fields of the records besides type
 class CountryData(ParserData):
     type = 'countrydata'
+    fields = ('country', 'continent', 'population', 'total_cases', 'new_cases', 'total_deaths', 'new_deaths',
+              'active_cases', 'total_recovered', 'serious_critical', 'total_per_1m', 'total_deaths_per_1m',
+              'total_tests', 'total_tests_per_1m', 'date')
 
 class DetailData(ParserData):
     type = 'detaildata'
+    fields = ('country', 'cases', 'deaths', 'active')
 
 class PopulationData(ParserData):
     type = 'populationdata'
+    fields = ('country', 'population')
 
 
 class WOMParser():
 
-    def __init__(self, url):
+    def __init__(self, url, jobs=1):
         self.url = url
+        self.jobs = jobs
+        self.checkpoint = Checkpoint()
+        # country -> (summary, (cases, deaths, active)) of an earlier run
+        self.previous = {}
+
+    def fetch(self, url, check=True):
+        return download(url, check=check)
+
+    def readpage(self, body):
+        from lxml import html
+        parser = html.HTMLParser()
+        with body.view() as view:
+            for i in range(0, len(view), 1 << 16):
+                parser.feed(bytes(view[i:i + (1 << 16)]))
+        return parser.close()
+
+    def getpage(self, url, check=True):
+        with self.fetch(url, check) as body:
+            return self.readpage(body)
 
     def parsenumber(self, text):
-        if text is None:
-            return text
-        try:
-            return int(text.replace(',',''))
-        except ValueError:
-            return text
+        return counts([text])[0]
         
     def parsecountries(self):
-        r = requests.get(self.url)
-        r.raise_for_status()
-        page = html.fromstring(r.content)
+        page = self.getpage(self.url)
+        for (countrydata, href) in self.countryrows(page):
+            yield countrydata
 
+    # (CountryData, link to the country page) for the rows of the summary
+    # table
+    def countryrows(self, page):
         #table = page.xpath('//*[@id="main_table_countries_today"]/tbody[1]')[0]
         table = page.xpath('//*[@id="main_table_countries_yesterday"]/tbody[1]')[0]
         #country_element = table.xpath("//td[contains(., 'USA')]")[0]
@@ -69,7 +99,7 @@ class WOMParser():
                 continue
             country = links[0].text
             
-            data = [self.parsenumber(td.text) for td in row.xpath("td")]
+            data = counts([td.text for td in row.xpath("td")])
 
             baseidx = 1
             
@@ -122,12 +152,10 @@ class WOMParser():
                 population = population,
                 #data = str(data),
             )
-            yield countrydata
+            yield countrydata, links[0].attrib.get('href')
 
     def parsepopulation(self):
-        r = requests.get(self.url)
-        r.raise_for_status()
-        page = html.fromstring(r.content)
+        page = self.getpage(self.url)
 
         table = page.xpath('//*[@id="example2"]/tbody[1]')[0]
         for row in table.xpath("tr"):
@@ -139,7 +167,7 @@ class WOMParser():
                 continue
             country = country_elem[0].text
 
-            data = [self.parsenumber(td.text) for td in row.xpath("td")]
+            data = counts([td.text for td in row.xpath("td")])
 
             population = data[2]
 
@@ -156,22 +184,26 @@ class WOMParser():
 
 
     def parsedetails(self):
-        r = requests.get(self.url)
-        r.raise_for_status()
-        page = html.fromstring(r.content)
-
-        table = page.xpath('//*[@id="main_table_countries_yesterday"]/tbody[1]')[0]
-
-        for row in table.xpath("tr"):
-            if row.attrib.get("class") in ["total_row_world row_continent", "total_row_world"]:
-                continue
-            country_elem = row.xpath("td/a")
-            if not country_elem:
-                continue
+        page = self.getpage(self.url)
 
-            country = country_elem[0].text
-            url = country_elem[0].attrib.get('href')
-            (cases, deaths, active) = self.parsecountry(country, url)
+        countries = []
+        for (countrydata, href) in self.countryrows(page):
+            country = countrydata.country
+            if summary(countrydata.values()) == self.previous.get(country, (None,))[0]:
+                countries.append((country, None, self.previous[country][1]))
+            else:
+                countries.append((country, href, None))
+        fetch = [(country, href) for (country, href, series) in countries if series is None]
+        if self.previous:
+            print("details: fetching %d of %d countries" % (len(fetch), len(countries)), file=sys.stderr)
+
+        # the pages are parsed in table order, so their results are taken
+        # in turn between the countries that are reused
+        parsed = self.parsecountrypages(fetch)
+        for (country, href, series) in countries:
+            if series is None:
+                (country, series) = next(parsed)
+            (cases, deaths, active) = series
             detaildata = DetailData(
                 country=country,
                 cases = cases,
@@ -180,10 +212,69 @@ class WOMParser():
             )
  
             yield detaildata
-
+        # lets the worker pool shut down
+        for rest in parsed:
+            pass
+        self.checkpoint.finish()
+
+    # (country, parsecountry result) in order, countries found in the
+    # checkpoint are not fetched again; with jobs > 1 the pages are fetched
+    # here and parsed in worker processes while the next ones load
+    def parsecountrypages(self, countries):
+        if self.jobs <= 1:
+            for (country, url) in countries:
+                if country not in self.checkpoint:
+                    self.checkpoint.add(country, self.parsecountry(country, url))
+                yield country, self.checkpoint.get(country)
+            return
+
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor, Future
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(self.jobs, mp_context=context) as pool:
+            pending = collections.deque()
+            try:
+                for (country, url) in countries:
+                    if country in self.checkpoint:
+                        (body, future) = (None, Future())
+                        future.set_result(self.checkpoint.get(country))
+                    else:
+                        body = self.fetch(urllib.parse.urljoin(self.url, url), check=False)
+                        future = pool.submit(parsecountrybody, self.url, body)
+                    pending.append((country, body, future))
+                    while pending and (pending[0][2].done() or len(pending) > 2 * self.jobs):
+                        yield self.finishpage(*pending.popleft())
+            except Exception:
+                # keep the pages the workers have already parsed
+                while pending:
+                    try:
+                        self.finishpage(*pending.popleft())
+                    except Exception:
+                        pass
+                raise
+            while pending:
+                yield self.finishpage(*pending.popleft())
+
+    def finishpage(self, country, body, future):
+        try:
+            result = future.result()
+        finally:
+            if body is not None:
+                body.release()
+        if country not in self.checkpoint:
+            self.checkpoint.add(country, result)
+        return country, result
+
+    # a country without a page gets empty series, server errors are
+    # retried by the fetch layer and fail the run if they persist
     def parsecountry(self, country, url):
-        r = requests.get(urllib.parse.urljoin(self.url, url))
-        page = html.fromstring(r.content)
+        with self.fetch(urllib.parse.urljoin(self.url, url), check=False) as body:
+            return self.parsecountrybody(body)
+
+    # runs in a worker when jobs > 1, the body is mapped from its spool file
+    def parsecountrybody(self, body):
+        with body:
+            page = self.readpage(body)
         
         if False:
             script = page.xpath('//div[@id="graph-cases-daily"]/following-sibling::script[1]')
@@ -260,6 +351,80 @@ class WOMParser():
             dates.append(d.strftime('%Y-%m-%d'))
         return dates
 
+# the summary row fields that change whenever a country's page does
+def summary(values):
+    return [values.get('total_cases'), values.get('total_deaths'), values.get('active_cases')]
+
+
+def readrecords(path):
+    with open(path, encoding='utf-8') as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+# country -> (summary, series) from the countries and details outputs of
+# the latest earlier day in directory that has both
+def loadprevious(directory, before):
+    dates = set()
+    for name in os.listdir(directory or '.'):
+        m = re.match(r'details-(\d{8})\.json$', name)
+        if m and m.group(1) < before and os.path.exists(os.path.join(directory, 'countries-%s.json' % m.group(1))):
+            dates.add(m.group(1))
+    if not dates:
+        return {}
+    date = max(dates)
+    rows = {r['country']: summary(r) for r in readrecords(os.path.join(directory, 'countries-%s.json' % date))}
+    previous = {}
+    for r in readrecords(os.path.join(directory, 'details-%s.json' % date)):
+        if r['country'] in rows:
+            previous[r['country']] = (rows[r['country']], (r['cases'], r['deaths'], r['active']))
+    print("details: comparing with the run of %s" % date, file=sys.stderr)
+    return previous
+
+
+# parse worker entry point, only the url and the body are sent to it
+def parsecountrybody(url, body):
+    return WOMParser(url).parsecountrybody(body)
+
+
+cov_url = 'https://www.worldometers.info/coronavirus/'
+pop_url = 'https://www.worldometers.info/world-population/population-by-country/'
+
+datasets = {
+    'countries': (cov_url, 'parsecountries'),
+    'details': (cov_url, 'parsedetails'),
+    'population': (pop_url, 'parsepopulation'),
+}
+
+recordclasses = {
+    'countries': CountryData,
+    'details': DetailData,
+    'population': PopulationData,
+}
+
+# keys of the --partitioned output (partitions.py)
+partitionby = {
+    'countries': ('continent',),
+}
+
+
+# the fields of a dataset's records (the csv columns)
+def outputfields(dataset, derived=None):
+    recordclass = recordclasses[dataset]
+    names = list(recordclass.fields) + ['type'] + (derived.fieldnames() if derived else [])
+    return fieldorder(recordclass.type, names)
+
+
+# with derived, the records are written once all of them are read
+def run(parsermethod, output, derived=None):
+    if derived is None:
+        for event in parsermethod():
+            writerecord(output, event)
+        return
+    derived.add(parsermethod())
+    for event in derived.finish():
+        writerecord(output, event)
+
+
 def main():
     p = argparse.ArgumentParser()
     p.add_argument(
@@ -289,49 +454,104 @@ def main():
         default=False,
         help="overwrite existing outputfile",
     )
-    p.add_argument("dataset", choices=['countries', 'details', 'population'])
+    p.add_argument(
+        "--profile",
+        action="store_const",
+        const="trace",
+        dest="profile",
+        default=None,
+        help="write a pstats dump and collapsed stacks next to the outputfile",
+    )
+    p.add_argument(
+        "--profile-sample",
+        action="store_const",
+        const="sample",
+        dest="profile",
+        help="like --profile but sample the stack instead of tracing",
+    )
+    p.add_argument(
+        "--partitioned",
+        action="store_true",
+        dest="partitioned",
+        default=False,
+        help="write the records into a directory tree partitioned by --partition-by",
+    )
+    p.add_argument(
+        "--partition-by",
+        action="store",
+        dest="partitionby",
+        default=None,
+        help="comma separated partition keys (fields, isoyear, isoweek) instead of the dataset's own",
+    )
+    p.add_argument(
+        "--sqlite",
+        action="store",
+        dest="sqlite",
+        default=None,
+        help="load the records into this sqlite database instead of a file",
+    )
+    p.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        dest="jobs",
+        default=1,
+        help="parse the detail pages in this many processes",
+    )
+    p.add_argument(
+        "--restart",
+        action="store_true",
+        dest="restart",
+        default=False,
+        help="discard the checkpoint of an earlier failed run",
+    )
+    p.add_argument(
+        "--changed-only",
+        action="store_true",
+        dest="changedonly",
+        default=False,
+        help="fetch the detail pages only for countries whose summary row changed since the previous run",
+    )
+    p.add_argument(
+        "--derived",
+        action="store_true",
+        dest="derived",
+        default=False,
+        help="add 7 day sums, incidence per 100 000 and growth of new cases and deaths to countries, from the earlier days' outputs",
+    )
+    p.add_argument(
+        "--population",
+        action="store",
+        dest="population",
+        default=None,
+        help="population output to use for --derived instead of the countries' own population",
+    )
+    p.add_argument("dataset", choices=datasets.keys())
 
     options = p.parse_args()
     dataset = options.dataset
 
-    cov_url = 'https://www.worldometers.info/coronavirus/'
-    pop_url = 'https://www.worldometers.info/world-population/population-by-country/'
-
     if options.outputfile:
         outputfile = options.outputfile
     else:
         datestr = datetime.date.today().strftime("%Y%m%d")
-        outputfile = "%s-%s.json" % (dataset, datestr)
-
-    if dataset == 'countries':
-        parser = WOMParser(cov_url)
-        parsermethod = parser.parsecountries
-
-    elif dataset == 'details':
-        parser = WOMParser(cov_url)
-        parsermethod = parser.parsedetails
-
-    elif dataset == 'population':
-        parser = WOMParser(pop_url)
-        parsermethod = parser.parsepopulation
-
-    else:
-        usage()
-        return
-
-    if parsermethod:
-        if options.write_stdout:
-            for event in parsermethod():
-                print(event.tojson())
-
-        else:
-            if os.path.exists(outputfile) and os.path.getsize(outputfile) > 0 and not options.overwrite:
-                print("%s exists" % outputfile)
-                return
-
-            with open(outputfile, 'w') as fp:
-                for event in parsermethod():
-                    print(event.tojson(), file=fp)
+        outputfile = "%s-%s.%s" % (dataset, datestr, "csv" if options.csv else "json")
+
+    (url, methodname) = datasets[dataset]
+    parser = WOMParser(url, options.jobs)
+    parser.checkpoint = Checkpoint(outputfile + ".checkpoint", [dataset, str(datetime.date.today())], options.restart)
+    if options.changedonly and dataset == 'details':
+        parser.previous = loadprevious(os.path.dirname(outputfile), datetime.date.today().strftime("%Y%m%d"))
+    parsermethod = getattr(parser, methodname)
+    derived = None
+    if options.derived and dataset == 'countries':
+        derived = Derived('date', ('country',), ('new_cases', 'new_deaths'),
+                          loadpopulation(options.population) if options.population else None, "_")
+        derived.add(loadhistory(os.path.dirname(outputfile), dataset, datetime.date.today().strftime("%Y%m%d")), True)
+
+    writeoutput(options, outputfile, lambda out: profile(options.profile, outputfile, run, parsermethod, out, derived),
+                partitionby.get(dataset, ()), fields=lambda: outputfields(dataset, derived))
 
 
 if __name__ == "__main__":